@@ -0,0 +1,91 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import sys
+import threading
+import time
+
+MOCK_LATENCY=0.2
+MOCK_TOKENS_PER_SECOND=100
+
+def mock_content(request: dict) -> str:
+    # Replies shaped like what each step parses, chosen from the prompt
+    prompt = "\n".join(str(message.get("content", "")) for message in request.get("messages", []))
+
+    if (request.get("response_format") or {}).get("type") == "json_object":
+        case_ids = re.findall(r"^Case (\S+):", prompt, re.MULTILINE)
+        if case_ids:
+            return json.dumps({"results": [{"id": case_id, "accuracy": True} for case_id in case_ids]})
+        return json.dumps({"accuracy": True})
+
+    if "'detail' and 'generated_query' keys" in prompt:
+        return json.dumps([
+            {"detail": "The mock answer states a fact", "generated_query": "What fact does the mock answer state?"},
+            {"detail": "The mock answer states another fact", "generated_query": "What other fact does the mock answer state?"}
+        ])
+
+    num_queries = re.search(r"Generate (\d+) different search queries", prompt)
+    if num_queries:
+        return "\n".join(f"Mock search query {i + 1}" for i in range(int(num_queries.group(1))))
+
+    if "FOLLOW UP QUESTION" in prompt:
+        return "Are FOLLOW UP QUESTIONs needed here: No.\nFINAL ANSWER: mock answer"
+
+    return "mock answer"
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    # Answers chat completions requests of the OpenAI and Azure OpenAI clients after
+    # latency + completion tokens / tokens_per_second seconds
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.split("?")[0].endswith("/chat/completions"):
+            self.send_error(404)
+            return
+
+        content = mock_content(request)
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in request.get("messages", [])) // 4 + 1
+        completion_tokens = len(content) // 4 + 1
+        time.sleep(self.server.latency + completion_tokens / self.server.tokens_per_second)
+
+        body = json.dumps({
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        }).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MockLLMServer:
+    def __init__(self, latency: float = MOCK_LATENCY, tokens_per_second: float = MOCK_TOKENS_PER_SECOND, port: int = 0):
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), MockLLMHandler)
+        self.server.daemon_threads = True
+        self.server.latency = latency
+        self.server.tokens_per_second = tokens_per_second
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self) -> "MockLLMServer":
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == "__main__":
+    server = MockLLMServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8000)
+    print(f"Mock LLM listening on {server.url}")
+    server.server.serve_forever()
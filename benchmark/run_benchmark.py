@@ -0,0 +1,111 @@
+from mock_llm import MockLLMServer
+from synthetic_crag import write_synthetic_crag
+from typing import Dict, List
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+BASE_DIR=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKSPACE=os.path.join(BASE_DIR, "benchmark", "workspace")
+sys.path.append(BASE_DIR)
+from run_experiments import STAGES, build_steps
+
+NUM_ITEMS=20
+PAGES_PER_ITEM=5
+HTML_BYTES=50000
+MOCK_LATENCY=0.2
+MOCK_TOKENS_PER_SECOND=100
+EMBEDDING_BACKEND="hashing"
+BENCHMARK_STAGES=STAGES
+
+def set_constants(path: str, constants: Dict[str, str]):
+    with open(path, "r") as source_file:
+        source = source_file.read()
+    for name, value in constants.items():
+        source = re.sub(rf"^{name}=.*$", f"{name}={value}", source, flags=re.MULTILINE)
+    with open(path, "w") as source_file:
+        source_file.write(source)
+
+def prepare_workspace(llm_url: str):
+    # A copy of the scripts pointed at the mock LLM and the synthetic data, so that the
+    # benchmark never touches the results, collections and caches of real runs
+    shutil.rmtree(WORKSPACE, ignore_errors=True)
+    for directory in ["common", "generate_contexts", "generate_answers", "llm_as_judge"]:
+        os.makedirs(os.path.join(WORKSPACE, directory))
+        for name in os.listdir(os.path.join(BASE_DIR, directory)):
+            if name.endswith(".py"):
+                shutil.copy(os.path.join(BASE_DIR, directory, name), os.path.join(WORKSPACE, directory, name))
+    for stage in STAGES:
+        os.makedirs(os.path.join(WORKSPACE, "results", stage))
+
+    for directory in ["generate_contexts", "generate_answers", "llm_as_judge"]:
+        llm_config_path = os.path.join(WORKSPACE, directory, "llm_config.py")
+        with open(llm_config_path, "r") as llm_config_file:
+            llm_config = llm_config_file.read()
+        llm_config = llm_config.replace('"AZURE_API_KEY"', '"mock"').replace('"AZURE_API_VERSION"', '"2024-06-01"')
+        llm_config = llm_config.replace('"AZURE_ENDPOINT"', json.dumps(llm_url)).replace('"AZURE_MODEL_NAME"', '"mock"')
+        with open(llm_config_path, "w") as llm_config_file:
+            llm_config_file.write(llm_config)
+
+    set_constants(os.path.join(WORKSPACE, "generate_contexts", "retriever.py"), {"EMBEDDING_BACKEND": json.dumps(EMBEDDING_BACKEND)})
+
+    write_synthetic_crag(os.path.join(WORKSPACE, "generate_contexts", "crag_task_3_dev_v4.jsonl.bz2"), NUM_ITEMS, PAGES_PER_ITEM, HTML_BYTES)
+    with open(os.path.join(WORKSPACE, "generate_contexts", "random_nums.txt"), "w") as random_nums_file:
+        random_nums_file.writelines(f"{line_number}\n" for line_number in range(NUM_ITEMS))
+
+def read_trace_summaries(since: float) -> Dict[str, Dict]:
+    traces_dir = os.path.join(WORKSPACE, "results", "traces")
+    summaries = {}
+    if os.path.exists(traces_dir):
+        for name in sorted(os.listdir(traces_dir)):
+            path = os.path.join(traces_dir, name)
+            if name.endswith(".summary.json") and os.path.getmtime(path) >= since:
+                with open(path, "r") as summary_file:
+                    summaries[name[:-len(".summary.json")]] = json.load(summary_file)
+    return summaries
+
+def run_benchmark(stages: List[str] = BENCHMARK_STAGES):
+    server = MockLLMServer(MOCK_LATENCY, MOCK_TOKENS_PER_SECOND).start()
+    try:
+        prepare_workspace(server.url)
+
+        # Steps run one after another so that their timings do not interfere
+        step_seconds = {}
+        step_summaries = {}
+        start = time.perf_counter()
+        for name, step in build_steps(stages).items():
+            step_start = time.time()
+            step_start_perf = time.perf_counter()
+            subprocess.run(
+                [sys.executable, "-c", step["code"]],
+                cwd=os.path.join(WORKSPACE, step["directory"]),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                check=True
+            )
+            step_seconds[name] = time.perf_counter() - step_start_perf
+            step_summaries[name] = read_trace_summaries(step_start)
+            print(f"{name}: {step_seconds[name]:.2f}s, {NUM_ITEMS / step_seconds[name]:.2f} test cases/s")
+        total_seconds = time.perf_counter() - start
+    finally:
+        server.stop()
+
+    print(f"\nEnd to end: {total_seconds:.2f}s for {NUM_ITEMS} test cases and {len(stages)} stages")
+    for name, summaries in step_summaries.items():
+        for summary in summaries.values():
+            print(f"\n{name}")
+            for span_name, stats in summary.items():
+                throughput = stats["count"] / stats["total_seconds"] if stats["total_seconds"] > 0 else float("inf")
+                print(f"  {span_name}: {stats['count']} in {stats['total_seconds']}s ({throughput:.1f}/s), p50 {stats['p50_ms']}ms, p95 {stats['p95_ms']}ms")
+
+if __name__ == "__main__":
+    selected_stages = sys.argv[1:] or BENCHMARK_STAGES
+    unknown_stages = [stage for stage in selected_stages if stage not in STAGES]
+    if unknown_stages:
+        raise ValueError(f"Unknown stages {unknown_stages}, choose from {STAGES}")
+
+    run_benchmark(selected_stages)
@@ -0,0 +1,71 @@
+from typing import Dict, List
+import bz2
+import json
+import random
+import sys
+import uuid
+
+VOCABULARY_SIZE=5000
+
+def make_vocabulary(rng: random.Random, size: int = VOCABULARY_SIZE) -> List[str]:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(3, 10))) for _ in range(size)]
+
+def synthetic_sentence(rng: random.Random, vocabulary: List[str]) -> str:
+    return " ".join(rng.choice(vocabulary) for _ in range(rng.randint(6, 20))).capitalize() + "."
+
+def synthetic_page(rng: random.Random, vocabulary: List[str], html_bytes: int) -> str:
+    # Paragraphs between the kind of boilerplate real pages carry, up to about html_bytes
+    parts = [
+        "<!DOCTYPE html><html><head><title>", synthetic_sentence(rng, vocabulary), "</title>",
+        "<style>body { font-family: sans-serif; } .nav { display: flex; }</style>",
+        "<script>window.dataLayer = window.dataLayer || []; function gtag() { dataLayer.push(arguments); }</script>",
+        "</head><body><div class=\"nav\"><a href=\"/\">Home</a><a href=\"/about\">About</a></div><main>"
+    ]
+    size = sum(map(len, parts))
+    while size < html_bytes:
+        paragraph = "<p>" + " ".join(synthetic_sentence(rng, vocabulary) for _ in range(rng.randint(2, 6))) + "</p>"
+        parts.append(paragraph)
+        size += len(paragraph)
+    parts.append("</main><footer>Copyright</footer></body></html>")
+    return "".join(parts)
+
+def synthetic_item(rng: random.Random, vocabulary: List[str], index: int, pages_per_item: int, html_bytes: int) -> Dict:
+    subject, attribute, answer = rng.choice(vocabulary), rng.choice(vocabulary), rng.choice(vocabulary)
+    return {
+        "interaction_id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "query_time": "03/01/2024, 00:00:00 PT",
+        "domain": "open",
+        "question_type": "simple",
+        "static_or_dynamic": "static",
+        "query": f"What is the {attribute} of {subject}?",
+        "answer": answer,
+        "alt_ans": [],
+        "search_results": [
+            {
+                "page_name": synthetic_sentence(rng, vocabulary),
+                "page_url": f"https://example.com/{index}/{page}",
+                "page_snippet": synthetic_sentence(rng, vocabulary),
+                "page_result": synthetic_page(rng, vocabulary, html_bytes),
+                "page_last_modified": ""
+            }
+            for page in range(pages_per_item)
+        ]
+    }
+
+def write_synthetic_crag(path: str, num_items: int, pages_per_item: int = 5, html_bytes: int = 50000, seed: int = 0):
+    # Same line format as crag_task_3_dev_v4.jsonl.bz2
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng)
+
+    with bz2.open(path, "wt") as output_file:
+        for index in range(num_items):
+            output_file.write(json.dumps(synthetic_item(rng, vocabulary, index, pages_per_item, html_bytes)) + "\n")
+
+    print(f"Wrote {num_items} synthetic test cases with {pages_per_item} pages of about {html_bytes} bytes to {path}")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        raise SystemExit("Usage: python3 synthetic_crag.py <output.jsonl.bz2> <test cases> [pages per test case] [HTML bytes per page]")
+
+    write_synthetic_crag(sys.argv[1], int(sys.argv[2]), *map(int, sys.argv[3:5]))
@@ -0,0 +1,48 @@
+from functools import lru_cache
+from typing import Dict, List
+import hashlib
+import os
+import sqlite3
+import zlib
+
+CHUNK_STORE_PATH=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "results", "chunk_store.sqlite")
+
+def chunk_key(text: str) -> str:
+    # Chunks are stored once by content, whichever test case, configuration or result file uses them
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+@lru_cache(maxsize=None)
+def get_connection(path: str = CHUNK_STORE_PATH) -> sqlite3.Connection:
+    # Parallel steps write and read the store concurrently
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("CREATE TABLE IF NOT EXISTS chunks (key TEXT PRIMARY KEY, text BLOB NOT NULL)")
+    return connection
+
+def put_chunks(texts: List[str], path: str = CHUNK_STORE_PATH) -> List[str]:
+    keys = [chunk_key(text) for text in texts]
+    get_connection(path).executemany(
+        "INSERT OR IGNORE INTO chunks (key, text) VALUES (?, ?)",
+        [(key, zlib.compress(text.encode("utf-8"))) for key, text in zip(keys, texts)]
+    )
+    return keys
+
+def get_chunks(keys: List[str], path: str = CHUNK_STORE_PATH) -> List[str]:
+    rows = get_connection(path).execute(
+        f"SELECT key, text FROM chunks WHERE key IN ({', '.join('?' * len(keys))})",
+        list(keys)
+    ).fetchall()
+    texts: Dict[str, str] = {key: zlib.decompress(text).decode("utf-8") for key, text in rows}
+
+    missing = [key for key in keys if key not in texts]
+    if missing:
+        raise KeyError(f"{len(missing)} chunks missing from {path}, generate the contexts again")
+    return [texts[key] for key in keys]
+
+def resolve_contexts(item: Dict) -> List[str]:
+    # Records of contexts files either carry the chunk texts or only their keys
+    if "contexts" in item:
+        return item["contexts"]
+    return get_chunks(item["context_keys"]) if item["context_keys"] else [""]
@@ -0,0 +1,142 @@
+from openai.types.chat import ChatCompletion
+from common.tracing import span
+from types import SimpleNamespace
+from typing import Optional
+import hashlib
+import json
+import openai
+import os
+import sqlite3
+import threading
+import time
+
+LLM_CACHE_PATH=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "llm_cache.sqlite")
+MAX_CACHE_BYTES=2 * 1024 ** 3
+EVICTION_CHECK_INTERVAL=100
+
+class LLMCache:
+    # Responses are stored by a hash of everything that determines them and evicted least
+    # recently used first once the cache grows beyond max_bytes
+    def __init__(self, path: str = LLM_CACHE_PATH, max_bytes: int = MAX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self.db.commit()
+
+    @staticmethod
+    def key(kwargs: dict) -> str:
+        request = {
+            "model": kwargs.get("model"),
+            "temperature": kwargs.get("temperature"),
+            "messages": kwargs.get("messages"),
+            "response_format": kwargs.get("response_format")
+        }
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+            return row[0]
+
+    def put(self, key: str, response: str):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses (key, response, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, len(response), time.time())
+            )
+            self.db.commit()
+
+            self.puts += 1
+            if self.puts % EVICTION_CHECK_INTERVAL == 0:
+                self._evict()
+
+    def _evict(self):
+        while (self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]) > self.max_bytes:
+            self.db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access LIMIT ?)",
+                (EVICTION_CHECK_INTERVAL,)
+            )
+            self.db.commit()
+
+    def report(self) -> str:
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total > 0 else 0
+        return f"LLM cache: {self.hits} hits, {self.misses} misses, hit rate {hit_rate:.2%}"
+
+def trace_usage(attributes: dict, response: ChatCompletion, cached: bool) -> ChatCompletion:
+    # Tokens are only counted for responses actually requested from the LLM
+    attributes["cached"] = int(cached)
+    if response.usage is not None and not cached:
+        attributes["prompt_tokens"] = response.usage.prompt_tokens
+        attributes["completion_tokens"] = response.usage.completion_tokens
+    return response
+
+class CachedCompletions:
+    def __init__(self, cached_llm: "CachedLLM"):
+        self.cached_llm = cached_llm
+
+    def create(self, use_cache: bool = True, **kwargs) -> ChatCompletion:
+        # use_cache=False skips the lookup, e.g. to retry a response that failed to parse
+        with span("llm") as attributes:
+            if use_cache:
+                response = self.cached_llm.lookup(**kwargs)
+                if response is not None:
+                    return trace_usage(attributes, response, cached=True)
+
+            response = self.cached_llm.client.chat.completions.create(**kwargs)
+            self.cached_llm.store(response, **kwargs)
+            return trace_usage(attributes, response, cached=False)
+
+class AsyncCachedCompletions(CachedCompletions):
+    async def create(self, use_cache: bool = True, **kwargs) -> ChatCompletion:
+        with span("llm") as attributes:
+            if use_cache:
+                response = self.cached_llm.lookup(**kwargs)
+                if response is not None:
+                    return trace_usage(attributes, response, cached=True)
+
+            response = await self.cached_llm.client.chat.completions.create(**kwargs)
+            self.cached_llm.store(response, **kwargs)
+            return trace_usage(attributes, response, cached=False)
+
+class CachedLLM:
+    # Drop-in replacement for a (sync or async) OpenAI client as far as chat.completions.create goes,
+    # passing every request through when cache is None
+    def __init__(self, client, cache: Optional[LLMCache]):
+        self.client = client
+        self.cache = cache
+
+        if isinstance(client, openai.AsyncOpenAI):
+            self.chat = SimpleNamespace(completions=AsyncCachedCompletions(self))
+        else:
+            self.chat = SimpleNamespace(completions=CachedCompletions(self))
+
+    def lookup(self, **kwargs) -> Optional[ChatCompletion]:
+        if self.cache is None:
+            return None
+
+        cached = self.cache.get(LLMCache.key(kwargs))
+        return ChatCompletion.model_validate_json(cached) if cached is not None else None
+
+    def store(self, response: ChatCompletion, **kwargs):
+        if self.cache is not None and response.choices and response.choices[0].message.content is not None:
+            self.cache.put(LLMCache.key(kwargs), response.model_dump_json())
+
+    def cache_report(self) -> str:
+        return self.cache.report() if self.cache is not None else "LLM cache: disabled"
@@ -0,0 +1,56 @@
+from typing import Optional, Set, TextIO, Tuple
+import hashlib
+import json
+import os
+
+FINGERPRINT_SUFFIX=".fingerprint"
+
+def compute_fingerprint(params: dict) -> str:
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+def read_fingerprint(path: str) -> Optional[str]:
+    if not os.path.exists(path + FINGERPRINT_SUFFIX):
+        return None
+
+    with open(path + FINGERPRINT_SUFFIX, "r") as fingerprint_file:
+        return json.load(fingerprint_file)["fingerprint"]
+
+def read_done_ids(path: str) -> Set:
+    done_ids = set()
+    valid_lines = []
+    truncated = False
+
+    with open(path, "r") as output_file:
+        for line in output_file:
+            try:
+                done_ids.add(json.loads(line)["id"])
+                valid_lines.append(line if line.endswith("\n") else line + "\n")
+            except (json.JSONDecodeError, KeyError):
+                truncated = True
+
+    # Drop a record left half-written by an interrupted run
+    if truncated:
+        with open(path, "w") as output_file:
+            output_file.writelines(valid_lines)
+
+    return done_ids
+
+def open_output(path: str, params: dict) -> Tuple[TextIO, Set]:
+    # Results of a previous run with the same parameters are kept and only missing ids are
+    # appended; results produced with other parameters are discarded
+    fingerprint = compute_fingerprint(params)
+
+    if os.path.exists(path) and read_fingerprint(path) == fingerprint:
+        done_ids = read_done_ids(path)
+        if done_ids:
+            print(f"Resuming {path}, {len(done_ids)} test cases already completed")
+        return open(path, "a"), done_ids
+
+    if os.path.exists(path):
+        print(f"Parameters changed since {path} was written, starting over")
+
+    output_file = open(path, "w")
+    with open(path + FINGERPRINT_SUFFIX, "w") as fingerprint_file:
+        json.dump({"fingerprint": fingerprint, "params": params}, fingerprint_file, indent=2)
+
+    return output_file, set()
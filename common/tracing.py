@@ -0,0 +1,122 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple
+import json
+import math
+import os
+import threading
+import time
+
+TRACE_DIR=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "results", "traces")
+TRACING=True
+
+_span_path: ContextVar[Tuple[str, ...]] = ContextVar("span_path", default=())
+_item_trace: ContextVar[Optional[Dict]] = ContextVar("item_trace", default=None)
+
+class Tracer:
+    # Durations of every span are collected by name for the summary, and the spans of each test
+    # case are written as one record of {name}.jsonl in TRACE_DIR
+    def __init__(self):
+        self.name = None
+        self.trace_file = None
+        self.durations: Dict[str, List[float]] = defaultdict(list)
+        self.totals: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self.lock = threading.Lock()
+
+    def start(self, name: str, resume: bool = False):
+        # A resumed step appends the traces of the remaining test cases to those already written
+        self.name = name
+        if TRACING:
+            os.makedirs(TRACE_DIR, exist_ok=True)
+            self.trace_file = open(os.path.join(TRACE_DIR, f"{name}.jsonl"), "a" if resume else "w")
+
+    def record(self, name: str, seconds: float, **attributes):
+        path = "/".join(_span_path.get() + (name,))
+        with self.lock:
+            self.durations[path].append(seconds)
+            for key, value in attributes.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self.totals[path][key] += value
+
+        item_trace = _item_trace.get()
+        if item_trace is not None:
+            item_trace["spans"].append({"name": path, "seconds": round(seconds, 6), **attributes})
+
+    def write_item(self, item_trace: Dict):
+        if self.trace_file is not None:
+            with self.lock:
+                self.trace_file.write(json.dumps(item_trace) + "\n")
+                self.trace_file.flush()
+
+    def summary(self) -> Dict[str, Dict]:
+        summary = {}
+        with self.lock:
+            for path, durations in sorted(self.durations.items()):
+                ordered = sorted(durations)
+                summary[path] = {
+                    "count": len(ordered),
+                    "total_seconds": round(sum(ordered), 3),
+                    "p50_ms": round(percentile(ordered, 50) * 1000, 2),
+                    "p95_ms": round(percentile(ordered, 95) * 1000, 2),
+                    **{key: value for key, value in self.totals[path].items()}
+                }
+        return summary
+
+    def finish(self) -> str:
+        summary = self.summary()
+        if self.trace_file is not None:
+            self.trace_file.close()
+            with open(os.path.join(TRACE_DIR, f"{self.name}.summary.json"), "w") as summary_file:
+                json.dump(summary, summary_file, indent=2)
+
+        lines = [f"Trace summary of {self.name}:"]
+        for path, stats in summary.items():
+            extra = "".join(f", {key} {value:g}" for key, value in stats.items() if key not in ("count", "total_seconds", "p50_ms", "p95_ms"))
+            lines.append(
+                f"  {path}: {stats['count']} spans, {stats['total_seconds']}s total, "
+                f"p50 {stats['p50_ms']}ms, p95 {stats['p95_ms']}ms{extra}"
+            )
+        return "\n".join(lines)
+
+def percentile(ordered: List[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+tracer = Tracer()
+
+def start_trace(name: str, resume: bool = False):
+    tracer.start(name, resume)
+
+def finish_trace() -> str:
+    return tracer.finish()
+
+def record(name: str, seconds: float, **attributes):
+    # For durations measured elsewhere, e.g. in a worker process
+    tracer.record(name, seconds, **attributes)
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Dict]:
+    # Nested spans are named by their path, e.g. "cot/llm". The yielded dict takes attributes
+    # only known at the end of the span, such as token counts
+    token = _span_path.set(_span_path.get() + (name,))
+    start = time.perf_counter()
+    try:
+        yield attributes
+    finally:
+        seconds = time.perf_counter() - start
+        _span_path.reset(token)
+        tracer.record(name, seconds, **attributes)
+
+@contextmanager
+def trace_item(item_id) -> Iterator[Dict]:
+    item_trace = {"id": item_id, "spans": []}
+    token = _item_trace.set(item_trace)
+    start = time.perf_counter()
+    try:
+        yield item_trace
+    finally:
+        item_trace["seconds"] = round(time.perf_counter() - start, 6)
+        _item_trace.reset(token)
+        tracer.write_item(item_trace)
@@ -0,0 +1,90 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Estimated prompt tokens available for the contexts of one request, None for no limit. A budget
+# can leave out retrieved passages and change the results, which are reported without one
+CONTEXT_TOKEN_BUDGET=None
+CHARS_PER_TOKEN=4
+MIN_OVERLAP_CHARS=20
+
+def estimate_text_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def parse_chunk_id(chunk_id: str) -> Optional[Tuple[str, int]]:
+    # Chunk ids are {page_url}_{interaction_id}_{chunk index}, see generate_contexts.add_pages
+    page, _, index = chunk_id.rpartition("_")
+    return (page, int(index)) if page and index.isdigit() else None
+
+def remove_overlap(previous: str, following: str) -> str:
+    # Drops the beginning of following that repeats the end of previous (CHUNK_OVERLAP)
+    probe = following[:MIN_OVERLAP_CHARS]
+    if len(probe) < MIN_OVERLAP_CHARS:
+        return following
+
+    position = previous.find(probe, max(0, len(previous) - len(following)))
+    while position != -1:
+        if following.startswith(previous[position:]):
+            return following[len(previous) - position:].lstrip()
+        position = previous.find(probe, position + 1)
+    return following
+
+def merge_chunks(contexts: Sequence[str], context_ids: Optional[Sequence[str]] = None) -> List[str]:
+    # Chunks of the same page become one passage, ranked by its best chunk. Neighbouring chunks
+    # are joined without their overlap, the others with an ellipsis. Repeated chunks are dropped
+    pages: Dict[str, List[Tuple[int, str]]] = {}
+    seen = set()
+
+    for rank, context in enumerate(contexts):
+        if not context or context in seen:
+            continue
+        seen.add(context)
+
+        parsed = parse_chunk_id(context_ids[rank]) if context_ids and rank < len(context_ids) else None
+        page, index = parsed if parsed else (f"#{rank}", 0)
+        pages.setdefault(page, []).append((index, context))
+
+    passages = []
+    for chunks in pages.values():
+        chunks.sort()
+        passage = chunks[0][1]
+        for (previous_index, previous), (index, chunk) in zip(chunks, chunks[1:]):
+            if index == previous_index + 1:
+                passage += " " + remove_overlap(previous, chunk)
+            else:
+                passage += " ... " + chunk
+        passages.append(passage)
+    return passages
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+
+    # Cut at the last sentence boundary within the budget, or at the last word boundary without one
+    cut = text[:max_chars]
+    boundary = cut.rfind(". ")
+    if boundary <= 0:
+        boundary = cut.rfind(" ")
+    return cut[:boundary + 1].rstrip() if boundary > 0 else cut
+
+def pack_contexts(
+    contexts: Sequence[str],
+    context_ids: Optional[Sequence[str]] = None,
+    token_budget: Optional[int] = CONTEXT_TOKEN_BUDGET
+) -> str:
+    # Numbered passages in retrieval order, the lowest ranked ones are shortened or left out
+    # when the budget is reached
+    packed = []
+    used_tokens = 0
+
+    for number, passage in enumerate(merge_chunks(contexts, context_ids), start=1):
+        prefix = f"[{number}] "
+        if token_budget is not None:
+            remaining_tokens = token_budget - used_tokens - estimate_text_tokens(prefix)
+            if remaining_tokens <= 0:
+                break
+            passage = truncate_to_tokens(passage, remaining_tokens)
+
+        packed.append(prefix + passage)
+        used_tokens += estimate_text_tokens(packed[-1])
+
+    return "\n\n".join(packed)
@@ -1,4 +1,5 @@
 from llm_config import *
+from common.tracing import span
 
 system_prompt_before_context = '''When necessary, you should decompose the USER QUESTION to FOLLOW UP QUESTIONs and answer the FOLLOW UP QUESTIONs according to the context information below but not your prior knowledge'''
 
@@ -50,15 +51,20 @@ FINAL ANSWER: Lana Clarkson
 USER QUESTION: '''
 
 
+def build_messages(contexts, query):
+    return [
+        {"role": "system", "content": system_prompt_before_context + "\n" + str(contexts)},
+        {"role": "user", "content": self_ask_prompt + query}
+    ]
+
+
 def llm_adapter(contexts, query):
-    response = llm.chat.completions.create(
-        model=MODEL_NAME,
-        temperature=TEMPERATURE,
-        messages=[
-            {"role": "system", "content": system_prompt_before_context + "\n" + str(contexts)},
-            {"role": "user", "content": self_ask_prompt + query}
-        ]
-    )
+    with span("cot"):
+        response = llm.chat.completions.create(
+            model=MODEL_NAME,
+            temperature=TEMPERATURE,
+            messages=build_messages(contexts, query)
+        )
 
     answer = response.choices[0].message.content
     print(f"Full answer from self_ask_context.llm_adapter: {answer}")
@@ -68,6 +74,22 @@ def llm_adapter(contexts, query):
     return clean_answer
 
 
+async def llm_adapter_async(contexts, query, engine):
+    with span("cot"):
+        response = await engine.create(
+            model=MODEL_NAME,
+            temperature=TEMPERATURE,
+            messages=build_messages(contexts, query)
+        )
+
+    answer = response.choices[0].message.content
+    print(f"Full answer from self_ask_context.llm_adapter_async: {answer}")
+
+    clean_answer = extract_answer(answer)
+
+    return clean_answer
+
+
 def extract_answer(generated):
     if generated is None:
         return generated
@@ -1,12 +1,14 @@
 from llm_config import *
-from cot import llm_adapter
-from typing import Sequence
+from cot import llm_adapter, llm_adapter_async
+from llm_engine import LLMEngine, map_in_order
+from context_packer import CONTEXT_TOKEN_BUDGET, pack_contexts
+from common.chunk_store import resolve_contexts
+from common.resume import open_output, read_fingerprint
+from common.tracing import finish_trace, span, start_trace, trace_item
+import asyncio
 import json
 
-def generate_answer(contexts: Sequence[str], query: str, use_cot: bool = False) -> str:
-    if use_cot:
-        return llm_adapter(contexts, query)
-    
+def build_messages(contexts: str, query: str) -> list:
     system_prompt = f"""Context information is below.
 ---------------------
 {contexts}
@@ -16,53 +18,116 @@ def generate_answer(contexts: Sequence[str], query: str, use_cot: bool = False)
 Query: {query}
 Answer: """
 
-    response = llm.chat.completions.create(
-        model=MODEL_NAME,
-        temperature=TEMPERATURE,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-    )
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def generate_answer(contexts: str, query: str, use_cot: bool = False) -> str:
+    if use_cot:
+        return llm_adapter(contexts, query)
+
+    with span("answer"):
+        response = llm.chat.completions.create(
+            model=MODEL_NAME,
+            temperature=TEMPERATURE,
+            messages=build_messages(contexts, query)
+        )
 
     return response.choices[0].message.content
 
-def process_test_cases(use_pre_retrieval: bool = False, use_cot: bool = False):
-    generated = 0
-    
+async def generate_answer_async(contexts: str, query: str, engine: LLMEngine, use_cot: bool = False) -> str:
+    if use_cot:
+        return await llm_adapter_async(contexts, query, engine)
+
+    with span("answer"):
+        response = await engine.create(
+            model=MODEL_NAME,
+            temperature=TEMPERATURE,
+            messages=build_messages(contexts, query)
+        )
+
+    return response.choices[0].message.content
+
+def item_contexts(item: dict) -> str:
+    with span("pack_contexts"):
+        return pack_contexts(resolve_contexts(item), item.get('context_ids'))
+
+async def generate_item_answer_async(item: dict, engine: LLMEngine, use_cot: bool) -> str:
+    with trace_item(item['id']):
+        return await generate_answer_async(item_contexts(item), item['query'], engine, use_cot)
+
+async def generate_answers_concurrently(items: list, use_cot: bool, max_concurrency: int, on_answer):
+    engine = LLMEngine(async_llm, max_concurrency, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+    await map_in_order(
+        lambda item: generate_item_answer_async(item, engine, use_cot),
+        items,
+        on_answer
+    )
+
+def process_test_cases(use_pre_retrieval: bool = False, use_cot: bool = False, max_concurrency: int = MAX_CONCURRENCY):
     input_path = "../results/contexts_with_pre-retrieval.jsonl" if use_pre_retrieval else "../results/contexts_without_pre-retrieval.jsonl"
-    
+
     if use_pre_retrieval:
         output_dir = "pre-retrieval+cot" if use_cot else "pre-retrieval"
     else:
         output_dir = "cot" if use_cot else "none"
-    
+
     output_path = f"../results/{output_dir}/test_cases.jsonl"
 
-    with open(input_path, 'r') as contexts_file, \
-         open(output_path, 'w') as answers_file:
-        
-        lines = contexts_file.readlines()
+    answers_file, done_ids = open_output(output_path, {
+        "stage": "answers",
+        "contexts": read_fingerprint(input_path),
+        "use_cot": use_cot,
+        "context_token_budget": CONTEXT_TOKEN_BUDGET,
+        "model_name": MODEL_NAME,
+        "temperature": TEMPERATURE
+    })
+    start_trace(f"{output_dir}_test_cases", resume=bool(done_ids))
+    generated = len(done_ids)
+
+    with open(input_path, 'r') as contexts_file, answers_file:
+
+        # Test cases are streamed, the chunk texts of each are only loaded when it is answered
+        items = (item for item in map(json.loads, contexts_file) if item['id'] not in done_ids)
+
+        def write_answer(item: dict, answer: str):
+            nonlocal generated
 
-        for line in lines:
-            item = json.loads(line)
-            
             answer_item = {
                 'id': item['id'],
                 'query': item['query'],
                 'ground_truth': item['ground_truth'],
-                'answer': generate_answer(item['contexts'], item['query'], use_cot)
+                'alt_ans': item.get('alt_ans', []),
+                'answer': answer
             }
-            
+            # RIG gating compares details with the contexts the answer was generated from
+            for key in ('context_ids', 'context_keys'):
+                if key in item:
+                    answer_item[key] = item[key]
+
             generated += 1
             cot_status = "with CoT" if use_cot else "without CoT"
             print(f"Generated answers {cot_status} for {generated} test cases")
 
-            answers_file.write(json.dumps(answer_item) + '\n')
-            answers_file.flush()
-    
+            with span("write"):
+                answers_file.write(json.dumps(answer_item) + '\n')
+                answers_file.flush()
+
+        if max_concurrency > 1:
+            asyncio.run(generate_answers_concurrently(items, use_cot, max_concurrency, write_answer))
+        else:
+            for item in items:
+                with trace_item(item['id']):
+                    answer = generate_answer(item_contexts(item), item['query'], use_cot)
+                write_answer(item, answer)
+
     print(f"Answers generation completed. Results stored in {output_path}")
+    print(llm.cache_report())
+    print(finish_trace())
 
-use_pre_retrieval = input("Used pre-retrieval for contexts generation? (T/F): ").upper() == 'T'
-use_cot = input("Use Chain of Thought reasoning for answers generation? (T/F): ").upper() == 'T'
-process_test_cases(use_pre_retrieval, use_cot)
\ No newline at end of file
+if __name__ == "__main__":
+    use_pre_retrieval = input("Used pre-retrieval for contexts generation? (T/F): ").upper() == 'T'
+    use_cot = input("Use Chain of Thought reasoning for answers generation? (T/F): ").upper() == 'T'
+    process_test_cases(use_pre_retrieval, use_cot)
@@ -1,9 +1,26 @@
-from openai import AzureOpenAI
+from openai import AzureOpenAI, AsyncAzureOpenAI
+import sys
 
-llm = AzureOpenAI(
+sys.path.append("..")
+from common.llm_cache import LLMCache, CachedLLM
+
+USE_LLM_CACHE=True
+
+llm_cache = LLMCache() if USE_LLM_CACHE else None
+
+llm = CachedLLM(AzureOpenAI(
     api_key="AZURE_API_KEY",
     api_version="AZURE_API_VERSION",
     azure_endpoint="AZURE_ENDPOINT"
-)
+), llm_cache)
+async_llm = CachedLLM(AsyncAzureOpenAI(
+    api_key="AZURE_API_KEY",
+    api_version="AZURE_API_VERSION",
+    azure_endpoint="AZURE_ENDPOINT",
+    max_retries=0
+), llm_cache)
 MODEL_NAME="AZURE_MODEL_NAME"
-TEMPERATURE=0.0
\ No newline at end of file
+TEMPERATURE=0.0
+MAX_CONCURRENCY=8
+REQUESTS_PER_MINUTE=None
+TOKENS_PER_MINUTE=None
\ No newline at end of file
@@ -0,0 +1,135 @@
+from typing import Any, Awaitable, Callable, Iterable, Optional
+from collections import deque
+from common.llm_cache import trace_usage
+from common.tracing import record
+import asyncio
+import openai
+import random
+import time
+
+MAX_ATTEMPTS=6
+BASE_BACKOFF=1.0
+MAX_BACKOFF=60.0
+# Items map_in_order starts ahead of the oldest unfinished one
+MAP_WINDOW=256
+
+class RateLimiter:
+    # Token bucket refilled continuously up to `per_minute`
+    def __init__(self, per_minute: Optional[float]):
+        self.per_minute = per_minute
+        self.available = per_minute or 0
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.per_minute, self.available + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1):
+        if not self.per_minute:
+            return
+
+        amount = min(amount, self.per_minute)
+        async with self.lock:
+            self._refill()
+            while self.available < amount:
+                await asyncio.sleep((amount - self.available) * 60 / self.per_minute)
+                self._refill()
+            self.available -= amount
+
+    def adjust(self, amount: float):
+        if self.per_minute:
+            self.available -= amount
+
+def estimate_tokens(messages: list) -> int:
+    return sum(len(str(message.get("content", ""))) for message in messages) // 4 + 1
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    response = getattr(error, "response", None)
+    if response is not None:
+        retry_after = response.headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+
+    return min(MAX_BACKOFF, BASE_BACKOFF * 2 ** attempt) + random.uniform(0, BASE_BACKOFF)
+
+class LLMEngine:
+    def __init__(
+        self,
+        client: openai.AsyncOpenAI,
+        max_concurrency: int,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_attempts: int = MAX_ATTEMPTS
+    ):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.request_limiter = RateLimiter(requests_per_minute)
+        self.token_limiter = RateLimiter(tokens_per_minute)
+        self.max_attempts = max_attempts
+
+    async def create(self, use_cache: bool = True, **kwargs):
+        # Same arguments as client.chat.completions.create
+        lookup = getattr(self.client, "lookup", None)
+        if lookup is not None:
+            # Cached responses skip the concurrency and rate limits
+            if use_cache:
+                start = time.perf_counter()
+                response = lookup(**kwargs)
+                if response is not None:
+                    # Traced like the hits of CachedCompletions, a miss is traced by the request below
+                    attributes = {}
+                    trace_usage(attributes, response, cached=True)
+                    record("llm", time.perf_counter() - start, **attributes)
+                    return response
+            kwargs["use_cache"] = False
+
+        estimated_tokens = estimate_tokens(kwargs["messages"])
+
+        async with self.semaphore:
+            for attempt in range(self.max_attempts):
+                await self.request_limiter.acquire()
+                await self.token_limiter.acquire(estimated_tokens)
+
+                try:
+                    response = await self.client.chat.completions.create(**kwargs)
+                except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                    if attempt + 1 >= self.max_attempts:
+                        raise
+
+                    delay = retry_delay(e, attempt)
+                    print(f"Retry {attempt + 1} in {delay:.1f}s: {str(e)}")
+                    await asyncio.sleep(delay)
+                    continue
+
+                if response.usage is not None:
+                    self.token_limiter.adjust(response.usage.total_tokens - estimated_tokens)
+                return response
+
+async def map_in_order(
+    fn: Callable[[Any], Awaitable[Any]],
+    items: Iterable[Any],
+    on_result: Callable[[Any, Any], None],
+    window: int = MAP_WINDOW
+):
+    # Up to `window` items run concurrently, results are handed over in input order. Items
+    # are read lazily, so a streamed input is never held in memory as a whole
+    running = deque()
+
+    try:
+        for item in items:
+            running.append((item, asyncio.create_task(fn(item))))
+            if len(running) >= window:
+                item, task = running.popleft()
+                on_result(item, await task)
+
+        while running:
+            item, task = running.popleft()
+            on_result(item, await task)
+    finally:
+        for _, task in running:
+            task.cancel()
@@ -1,16 +1,40 @@
 from llm_config import *
-from typing import Sequence
+from llm_engine import LLMEngine, map_in_order
+from context_packer import CONTEXT_TOKEN_BUDGET, pack_contexts
+from common.chunk_store import get_chunks
+from common.resume import open_output, read_fingerprint
+from common.tracing import finish_trace, span, start_trace, trace_item
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+import asyncio
 import json
-import chromadb
-import chromadb.utils.embedding_functions
-import torch
+import re
+import sys
 import time
 
-def generate_detail_queries(answer: str) -> list:
-    max_attempts = 5
-    for attempt in range(max_attempts):
-        try:
-            prompt = f"""Given this answer, extract key factual statements and generate specific queries to verify each statement. 
+sys.path.append("../generate_contexts")
+from retriever import (
+    EMBED_MODEL, CHUNK_SIZE, CHUNK_OVERLAP, DISTANCE_METRIC, CASCADE_RETRIEVAL, CASCADE_CANDIDATES,
+    MATRYOSHKA_DIM, MATRYOSHKA_RERANK_FACTOR, index_params, get_collection, query_collection
+)
+
+SIMILARITY_TOP_K=6
+MAX_ITEMS_IN_FLIGHT=4
+MAX_RETRIEVAL_CONCURRENCY=1
+# Gating skips verification where it is unlikely to change the answer: test cases whose answer
+# declines or whose best chunk for the query scores at least RIG_GATE_ITEM_SCORE keep their answer,
+# and details whose words are found in the original contexts (RIG_GATE_DETAIL_OVERLAP) or whose
+# verification retrieval mostly returns the original chunks (RIG_GATE_SAME_CHUNKS) are not verified
+RIG_GATING=False
+RIG_GATE_ITEM_SCORE=0.75
+RIG_GATE_DETAIL_OVERLAP=0.8
+RIG_GATE_SAME_CHUNKS=1.0
+DECLINE_PATTERN=re.compile(
+    r"not (available|provided|mentioned|found)|(cannot|can't|unable to) (find|determine|answer)|(does not|doesn't) (contain|provide|mention|include)",
+    re.IGNORECASE
+)
+
+def build_detail_queries_prompt(answer: str) -> str:
+    return f"""Given this answer, extract key factual statements and generate specific queries to verify each statement. 
 If the answer indicates that information is not available or cannot be found in the context, return an empty list [].
 Each detail must be a complete statement with a subject and predicate, not just isolated facts like names, dates, or numbers.
 
@@ -43,11 +67,18 @@ Examples that should return an empty list []:
 - "renewable energy" (just a concept)
 - "the dark knight" (just a movie title)
 - "John Smith, Mary Johnson, and David Chen" (just names)"""
+
+def generate_detail_queries(answer: str) -> list:
+    max_attempts = 5
+    for attempt in range(max_attempts):
+        try:
+            prompt = build_detail_queries_prompt(answer)
             
             response = llm.chat.completions.create(
                 model=MODEL_NAME,
                 temperature=TEMPERATURE,
-                messages=[{"role": "user", "content": prompt}]
+                messages=[{"role": "user", "content": prompt}],
+                use_cache=attempt == 0
             )
 
             return json.loads(response.choices[0].message.content)
@@ -59,27 +90,82 @@ Examples that should return an empty list []:
                 print(f"Failed after {max_attempts} attempts: {str(e)}")
                 return []
 
-def verify_detail(detail: str, generated_query: str, item_id: int) -> tuple[str, str]:
-    db = chromadb.PersistentClient(path="../generate_contexts/chromadb")
-    
-    collection_params = {
-        "name": f"collection_{item_id}",
-        "embedding_function": chromadb.utils.embedding_functions.SentenceTransformerEmbeddingFunction(
-            model_name="../generate_contexts/model/dunzhang/stella_en_1.5B_v5",
-            device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        )
+async def generate_detail_queries_async(answer: str, engine: LLMEngine) -> list:
+    max_attempts = 5
+    for attempt in range(max_attempts):
+        try:
+            response = await engine.create(
+                model=MODEL_NAME,
+                temperature=TEMPERATURE,
+                messages=[{"role": "user", "content": build_detail_queries_prompt(answer)}],
+                use_cache=attempt == 0
+            )
+
+            return json.loads(response.choices[0].message.content)
+        except Exception as e:
+            if attempt + 1 < max_attempts:
+                await asyncio.sleep(1)
+                print(f"Retry {attempt + 1}: {str(e)}")
+            else:
+                print(f"Failed after {max_attempts} attempts: {str(e)}")
+                return []
+
+def retrieve_detail_results(generated_queries: List[str], item_id: int) -> List[List[Dict]]:
+    # Contexts for all details of a test case are retrieved in one batched query
+    return query_collection(get_collection(item_id), generated_queries, SIMILARITY_TOP_K)
+
+def pack_results(results: List[Dict]) -> str:
+    return pack_contexts([result["document"] for result in results], [result["id"] for result in results])
+
+def content_words(text: str) -> Set[str]:
+    return {word for word in re.findall(r"\w+", text.lower()) if len(word) > 2 or word.isdigit()}
+
+def original_contexts(item: dict, original_results: List[Dict]) -> Tuple[Set[str], Set[str]]:
+    # The words and chunk ids of the contexts the answer was generated from when the answers
+    # file carries them, otherwise of the chunks retrieved for the query
+    if item.get("contexts"):
+        documents, ids = item["contexts"], item.get("context_ids") or []
+    elif item.get("context_keys"):
+        documents, ids = get_chunks(item["context_keys"]), item["context_ids"]
+    else:
+        documents, ids = [result["document"] for result in original_results], [result["id"] for result in original_results]
+    return content_words(" ".join(documents)), set(ids)
+
+def start_gate(item: dict, original_results: List[Dict]) -> dict:
+    skipped = None
+    if DECLINE_PATTERN.search(item["answer"] or ""):
+        skipped = "the answer declines"
+    elif original_results and original_results[0]["score"] >= RIG_GATE_ITEM_SCORE:
+        skipped = "retrieval for the query is confident"
+
+    return {
+        "skipped": skipped,
+        "top_score": original_results[0]["score"] if original_results else None,
+        "llm_calls": 0,
+        # Without gating, details are extracted and, unless the answer declines, a new answer is generated
+        "llm_calls_saved": (1 if skipped == "the answer declines" else 2) if skipped else 0
     }
-    
-    chroma_collection = db.get_collection(**collection_params)
-    
-    QueryResults = chroma_collection.query(
-        query_texts=[generated_query],
-        n_results=6,
-        include=["documents"]
-    )
-    
-    contexts: Sequence[str] = QueryResults['documents'][0] if QueryResults['documents'][0] else [""]
-    
+
+def count_calls(gate: Optional[dict], made: int, saved: int = 0):
+    if gate is not None:
+        gate["llm_calls"] += made
+        gate["llm_calls_saved"] += saved
+
+def gate_details(item: dict, detail_queries: list, details_results: List[List[Dict]], original_results: List[Dict]) -> List[Optional[str]]:
+    context_words, used_ids = original_contexts(item, original_results)
+
+    skip_reasons = []
+    for dq, results in zip(detail_queries, details_results):
+        detail_words = content_words(dq["detail"])
+        if detail_words and len(detail_words & context_words) / len(detail_words) >= RIG_GATE_DETAIL_OVERLAP:
+            skip_reasons.append("supported by the original contexts")
+        elif results and sum(result["id"] in used_ids for result in results) / len(results) >= RIG_GATE_SAME_CHUNKS:
+            skip_reasons.append("retrieval returns the original contexts")
+        else:
+            skip_reasons.append(None)
+    return skip_reasons
+
+def build_verification_messages(generated_query: str, contexts: str) -> list:
     system_prompt = f"""Context information is below.
 ---------------------
 {contexts}
@@ -88,20 +174,14 @@ def verify_detail(detail: str, generated_query: str, item_id: int) -> tuple[str,
     user_prompt = f"""Given the context information and not prior knowledge, answer the query.
 Query: {generated_query}
 Answer: """
-    
-    response = llm.chat.completions.create(
-        model=MODEL_NAME,
-        temperature=TEMPERATURE,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
-    )
 
-    answer_to_generated_query = response.choices[0].message.content
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
 
-    # Generate new_detail by comparing original detail with verification answer
-    new_detail_prompt = f"""Original detail: {detail}
+def build_new_detail_prompt(detail: str, generated_query: str, answer_to_generated_query: str) -> str:
+    return f"""Original detail: {detail}
 Verification query: {generated_query}
 Verification answer: {answer_to_generated_query}
 
@@ -110,16 +190,44 @@ If the original detail is accurate, return it unchanged. If it needs correction,
 
 Corrected detail: """
 
+def verify_detail(detail: str, generated_query: str, contexts: str) -> tuple[str, str]:
+    response = llm.chat.completions.create(
+        model=MODEL_NAME,
+        temperature=TEMPERATURE,
+        messages=build_verification_messages(generated_query, contexts)
+    )
+
+    answer_to_generated_query = response.choices[0].message.content
+
+    # Generate new_detail by comparing original detail with verification answer
     new_detail_response = llm.chat.completions.create(
         model=MODEL_NAME,
         temperature=TEMPERATURE,
-        messages=[{"role": "user", "content": new_detail_prompt}]
+        messages=[{"role": "user", "content": build_new_detail_prompt(detail, generated_query, answer_to_generated_query)}]
     )
     
     return answer_to_generated_query, new_detail_response.choices[0].message.content
 
-def generate_new_answer(original_answer: str, verified_details: list) -> str:
-    prompt = f"""Original answer: {original_answer}
+async def verify_detail_async(detail: str, generated_query: str, contexts: str, engine: LLMEngine) -> tuple[str, str]:
+    response = await engine.create(
+        model=MODEL_NAME,
+        temperature=TEMPERATURE,
+        messages=build_verification_messages(generated_query, contexts)
+    )
+
+    answer_to_generated_query = response.choices[0].message.content
+
+    # Generate new_detail by comparing original detail with verification answer
+    new_detail_response = await engine.create(
+        model=MODEL_NAME,
+        temperature=TEMPERATURE,
+        messages=[{"role": "user", "content": build_new_detail_prompt(detail, generated_query, answer_to_generated_query)}]
+    )
+
+    return answer_to_generated_query, new_detail_response.choices[0].message.content
+
+def build_new_answer_prompt(original_answer: str, verified_details: list) -> str:
+    return f"""Original answer: {original_answer}
 
 I have verified each detail in the original answer. For each detail, I have:
 1. Extracted the detail from the original answer ("detail" key)
@@ -137,6 +245,9 @@ Please generate a new answer that:
 4. Remains factual and accurate based on the verification results
 
 New answer: """
+
+def generate_new_answer(original_answer: str, verified_details: list) -> str:
+    prompt = build_new_answer_prompt(original_answer, verified_details)
     
     response = llm.chat.completions.create(
         model=MODEL_NAME,
@@ -146,9 +257,177 @@ New answer: """
 
     return response.choices[0].message.content
 
-def process_test_cases(use_pre_retrieval: bool = False, use_cot: bool = False):
-    output_count = 0
+async def generate_new_answer_async(original_answer: str, verified_details: list, engine: LLMEngine) -> str:
+    response = await engine.create(
+        model=MODEL_NAME,
+        temperature=TEMPERATURE,
+        messages=[{"role": "user", "content": build_new_answer_prompt(original_answer, verified_details)}]
+    )
+
+    return response.choices[0].message.content
+
+def build_result_item(item: dict, details_verification: list, new_answer: str, gate: Optional[dict] = None) -> dict:
+    result_item = {
+        "id": item["id"],
+        "query": item["query"],
+        "ground_truth": item["ground_truth"],
+        "alt_ans": item.get("alt_ans", []),
+        "answer": item["answer"],
+        "details_verification": details_verification,
+        "new_answer": new_answer
+    }
+    if gate is not None:
+        result_item["rig_gate"] = gate
+    return result_item
+
+def build_verified_detail(dq: dict, answer_to_generated_query: str, new_detail: str) -> dict:
+    return {
+        "detail": dq["detail"],
+        "generated_query": dq["generated_query"],
+        "answer_to_generated_query": answer_to_generated_query,
+        "new_detail": new_detail
+    }
+
+def build_skipped_detail(dq: dict, skipped: str) -> dict:
+    return {
+        "detail": dq["detail"],
+        "generated_query": dq["generated_query"],
+        "answer_to_generated_query": None,
+        "new_detail": dq["detail"],
+        "skipped": skipped
+    }
+
+def verified_details(details_verification: list) -> list:
+    return [detail for detail in details_verification if "skipped" not in detail]
+
+def process_item(item: dict) -> dict:
+    with trace_item(item["id"]):
+        gate = None
+        original_results = []
+        if RIG_GATING:
+            with span("retrieve", queries=1):
+                original_results = retrieve_detail_results([item["query"]], item["id"])[0]
+            gate = start_gate(item, original_results)
+            if gate["skipped"]:
+                print(f"Skipping verification for test case {item['id']} as {gate['skipped']}")
+                return build_result_item(item, None, item["answer"], gate)
+
+        # Step 1: Generate queries for details
+        with span("detail_queries"):
+            detail_queries = generate_detail_queries(item["answer"])
+        count_calls(gate, 1)
+
+        if not detail_queries:
+            print(f"Skipping verification for test case {item['id']} as no details are extracted")
+            return build_result_item(item, None, item["answer"], gate)
+
+        # Step 2: Verify each detail
+        details_verification = []
+        with span("retrieve", queries=len(detail_queries)):
+            details_results = retrieve_detail_results([dq["generated_query"] for dq in detail_queries], item["id"])
+        skip_reasons = gate_details(item, detail_queries, details_results, original_results) if gate is not None else [None] * len(detail_queries)
+        with span("verify", details=skip_reasons.count(None)):
+            for dq, results, skipped in zip(detail_queries, details_results, skip_reasons):
+                if skipped:
+                    details_verification.append(build_skipped_detail(dq, skipped))
+                    continue
+
+                answer_to_generated_query, new_detail = verify_detail(
+                    dq["detail"],
+                    dq["generated_query"],
+                    pack_results(results)
+                )
+                details_verification.append(build_verified_detail(dq, answer_to_generated_query, new_detail))
+        count_calls(gate, 2 * skip_reasons.count(None), 2 * (len(skip_reasons) - skip_reasons.count(None)))
 
+        # Step 3: Generate new answer
+        if not verified_details(details_verification):
+            count_calls(gate, 0, 1)
+            return build_result_item(item, details_verification, item["answer"], gate)
+
+        with span("new_answer"):
+            new_answer = generate_new_answer(item["answer"], verified_details(details_verification))
+        count_calls(gate, 1)
+
+        return build_result_item(item, details_verification, new_answer, gate)
+
+async def process_item_async(
+    item: dict,
+    engine: LLMEngine,
+    item_semaphore: asyncio.Semaphore,
+    retrieval_semaphore: asyncio.Semaphore,
+    retrieve_results: Optional[Callable[[List[str]], Awaitable[List[List[Dict]]]]] = None
+) -> dict:
+    # retrieve_results replaces retrieval from the test case's collection, e.g. in serve.py
+    async def retrieve(queries: List[str]) -> List[List[Dict]]:
+        async with retrieval_semaphore:
+            with span("retrieve", queries=len(queries)):
+                if retrieve_results is not None:
+                    return await retrieve_results(queries)
+                return await asyncio.to_thread(retrieve_detail_results, queries, item["id"])
+
+    async with item_semaphore:
+        with trace_item(item["id"]):
+            gate = None
+            original_results = []
+            if RIG_GATING:
+                original_results = (await retrieve([item["query"]]))[0]
+                gate = start_gate(item, original_results)
+                if gate["skipped"]:
+                    print(f"Skipping verification for test case {item['id']} as {gate['skipped']}")
+                    return build_result_item(item, None, item["answer"], gate)
+
+            # Step 1: Generate queries for details
+            with span("detail_queries"):
+                detail_queries = await generate_detail_queries_async(item["answer"], engine)
+            count_calls(gate, 1)
+
+            if not detail_queries:
+                print(f"Skipping verification for test case {item['id']} as no details are extracted")
+                return build_result_item(item, None, item["answer"], gate)
+
+            # Step 2: Verify all details concurrently once their contexts are retrieved
+            details_results = await retrieve([dq["generated_query"] for dq in detail_queries])
+            skip_reasons = gate_details(item, detail_queries, details_results, original_results) if gate is not None else [None] * len(detail_queries)
+
+            async def verify(dq: dict, results: List[Dict], skipped: Optional[str]) -> dict:
+                if skipped:
+                    return build_skipped_detail(dq, skipped)
+                answer_to_generated_query, new_detail = await verify_detail_async(dq["detail"], dq["generated_query"], pack_results(results), engine)
+                return build_verified_detail(dq, answer_to_generated_query, new_detail)
+
+            with span("verify", details=skip_reasons.count(None)):
+                details_verification = list(await asyncio.gather(*[
+                    verify(dq, results, skipped)
+                    for dq, results, skipped in zip(detail_queries, details_results, skip_reasons)
+                ]))
+            count_calls(gate, 2 * skip_reasons.count(None), 2 * (len(skip_reasons) - skip_reasons.count(None)))
+
+            # Step 3: Generate new answer
+            if not verified_details(details_verification):
+                count_calls(gate, 0, 1)
+                return build_result_item(item, details_verification, item["answer"], gate)
+
+            with span("new_answer"):
+                new_answer = await generate_new_answer_async(item["answer"], verified_details(details_verification), engine)
+            count_calls(gate, 1)
+
+            return build_result_item(item, details_verification, new_answer, gate)
+
+async def process_items_concurrently(test_cases: list, max_concurrency: int, on_result):
+    # LLM calls of all items share the engine's concurrency limit, while the number of items
+    # in flight and of concurrent retrievals on the local embedding model are bounded separately
+    engine = LLMEngine(async_llm, max_concurrency, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+    item_semaphore = asyncio.Semaphore(MAX_ITEMS_IN_FLIGHT)
+    retrieval_semaphore = asyncio.Semaphore(MAX_RETRIEVAL_CONCURRENCY)
+
+    await map_in_order(
+        lambda item: process_item_async(item, engine, item_semaphore, retrieval_semaphore),
+        test_cases,
+        on_result
+    )
+
+def process_test_cases(use_pre_retrieval: bool = False, use_cot: bool = False, max_concurrency: int = MAX_CONCURRENCY):
     if use_pre_retrieval:
         input_dir = "pre-retrieval+cot" if use_cot else "pre-retrieval"
     else:
@@ -162,63 +441,60 @@ def process_test_cases(use_pre_retrieval: bool = False, use_cot: bool = False):
     input_path = f"../results/{input_dir}/test_cases.jsonl"
     output_path = f"../results/{output_dir}/test_cases.jsonl"
 
-    with open(input_path, "r") as input_file, \
-        open(output_path, "w") as output_file:
+    output_file, done_ids = open_output(output_path, {
+        "stage": "rig",
+        "answers": read_fingerprint(input_path),
+        "similarity_top_k": SIMILARITY_TOP_K,
+        "context_token_budget": CONTEXT_TOKEN_BUDGET,
+        "index": index_params(EMBED_MODEL, CHUNK_SIZE, CHUNK_OVERLAP, DISTANCE_METRIC),
+        "cascade_candidates": CASCADE_CANDIDATES if CASCADE_RETRIEVAL else None,
+        "matryoshka_rerank_factor": MATRYOSHKA_RERANK_FACTOR if MATRYOSHKA_DIM else None,
+        "gating": [RIG_GATE_ITEM_SCORE, RIG_GATE_DETAIL_OVERLAP, RIG_GATE_SAME_CHUNKS] if RIG_GATING else None,
+        "model_name": MODEL_NAME,
+        "temperature": TEMPERATURE
+    })
+    start_trace(f"{output_dir}_test_cases", resume=bool(done_ids))
+    output_count = len(done_ids)
+    gate_totals = {"test_cases": 0, "skipped_test_cases": 0, "skipped_details": 0, "llm_calls": 0, "llm_calls_saved": 0}
+
+    with open(input_path, "r") as input_file, output_file:
         
-        test_cases = [json.loads(line) for line in input_file]
+        test_cases = (item for item in map(json.loads, input_file) if item["id"] not in done_ids)
 
-        for item in test_cases:    
-            # Step 1: Generate queries for details
-            detail_queries = generate_detail_queries(item["answer"])
-            
-            if not detail_queries:
-                print(f"Skipping verification for test case {item['id']} as no details are extracted")
-                result_item = {
-                    "id": item["id"],
-                    "query": item["query"],
-                    "ground_truth": item["ground_truth"],
-                    "answer": item["answer"],
-                    "details_verification": None,
-                    "new_answer": item["answer"]
-                }
-            else:
-                # Step 2: Verify each detail
-                details_verification = []
-                for dq in detail_queries:
-                    answer_to_generated_query, new_detail = verify_detail(
-                        dq["detail"],
-                        dq["generated_query"],
-                        item["id"]
-                    )
-                    verified_detail = {
-                        "detail": dq["detail"],
-                        "generated_query": dq["generated_query"],
-                        "answer_to_generated_query": answer_to_generated_query,
-                        "new_detail": new_detail
-                    }
-                    details_verification.append(verified_detail)
-                
-                # Step 3: Generate new answer
-                new_answer = generate_new_answer(item["answer"], details_verification)
-                
-                # Create result object with verification results
-                result_item = {
-                    "id": item["id"],
-                    "query": item["query"],
-                    "ground_truth": item["ground_truth"],
-                    "answer": item["answer"],
-                    "details_verification": details_verification,
-                    "new_answer": new_answer
-                }
-
-            output_file.write(json.dumps(result_item) + "\n")
-            output_file.flush()
+        def write_result(item: dict, result_item: dict):
+            nonlocal output_count
+
+            with span("write"):
+                output_file.write(json.dumps(result_item) + "\n")
+                output_file.flush()
             
             output_count += 1
             print(f"Generated answers with RIG for {output_count} test cases")
 
+            gate = result_item.get("rig_gate")
+            if gate is not None:
+                gate_totals["test_cases"] += 1
+                gate_totals["skipped_test_cases"] += gate["skipped"] is not None
+                gate_totals["skipped_details"] += sum("skipped" in detail for detail in result_item["details_verification"] or [])
+                gate_totals["llm_calls"] += gate["llm_calls"]
+                gate_totals["llm_calls_saved"] += gate["llm_calls_saved"]
+
+        if max_concurrency > 1:
+            asyncio.run(process_items_concurrently(test_cases, max_concurrency, write_result))
+        else:
+            for item in test_cases:
+                write_result(item, process_item(item))
+
     print(f"Answers generation with RIG completed. Results stored in {output_path}")
+    if gate_totals["test_cases"] > 0:
+        print(
+            f"Gating skipped {gate_totals['skipped_test_cases']} of {gate_totals['test_cases']} test cases and {gate_totals['skipped_details']} details, "
+            f"{gate_totals['llm_calls']} LLM calls made and at least {gate_totals['llm_calls_saved']} saved"
+        )
+    print(llm.cache_report())
+    print(finish_trace())
 
-use_pre_retrieval = input("Used pre-retrieval for contexts generation? (T/F): ").upper() == 'T'
-use_cot = input("Used Chain of Thought reasoning for answers generation? (T/F): ").upper() == 'T'
-process_test_cases(use_pre_retrieval, use_cot)
\ No newline at end of file
+if __name__ == "__main__":
+    use_pre_retrieval = input("Used pre-retrieval for contexts generation? (T/F): ").upper() == 'T'
+    use_cot = input("Used Chain of Thought reasoning for answers generation? (T/F): ").upper() == 'T'
+    process_test_cases(use_pre_retrieval, use_cot)
@@ -0,0 +1,290 @@
+from llm_config import *
+from llm_engine import LLMEngine
+from context_packer import pack_contexts
+from generate_answers import generate_answer_async
+from rig import process_item_async
+from common.tracing import record, span, start_trace, trace_item
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+import asyncio
+import contextvars
+import json
+import multiprocessing
+import numpy as np
+import sys
+import time
+import uuid
+
+sys.path.append("../generate_contexts")
+from generate_contexts import SIMILARITY_TOP_K, build_queries_messages, reciprocal_rank_fusion
+from preprocess import PREPROCESS_WORKERS, split_page_timed
+from retriever import EMBED_MODEL, CHUNK_SIZE, CHUNK_OVERLAP, DISTANCE_METRIC, get_embedding_function
+from vector_store import NumpyStore
+
+SERVE_HOST="127.0.0.1"
+SERVE_PORT=8080
+# Defaults of the pipeline, each request can override them
+USE_PRE_RETRIEVAL=True
+USE_COT=True
+USE_RIG=False
+# Texts of concurrent requests are embedded together, in batches of up to EMBED_BATCH_SIZE
+# texts collected for at most EMBED_BATCH_WAIT seconds
+EMBED_BATCH_SIZE=64
+EMBED_BATCH_WAIT=0.01
+MAX_REQUEST_BYTES=64 * 1024 ** 2
+
+class EmbeddingBatcher:
+    def __init__(self, embedding_function, max_batch_size: int = EMBED_BATCH_SIZE, max_wait: float = EMBED_BATCH_WAIT):
+        self.embedding_function = embedding_function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending = []
+        self.pending_texts = 0
+        self.flush_task = None
+        # The event loop only keeps weak references to tasks
+        self.flush_tasks = set()
+        self.model_lock = asyncio.Lock()
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((texts, future))
+        self.pending_texts += len(texts)
+
+        if self.pending_texts >= self.max_batch_size:
+            if self.flush_task is not None:
+                self.flush_task.cancel()
+            self._keep(asyncio.ensure_future(self._flush(self._take_pending())))
+        elif self.flush_task is None:
+            self.flush_task = self._keep(asyncio.ensure_future(self._flush_later()))
+
+        # Waiting for the batch to fill up and for earlier batches, plus the model time of the batch
+        with span("embed_wait", texts=len(texts)) as attributes:
+            vectors, attributes["model_seconds"] = await future
+            return vectors
+
+    def _keep(self, task: asyncio.Task) -> asyncio.Task:
+        self.flush_tasks.add(task)
+        task.add_done_callback(self.flush_tasks.discard)
+        return task
+
+    def _take_pending(self) -> list:
+        batch, self.pending, self.pending_texts, self.flush_task = self.pending, [], 0, None
+        return batch
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_wait)
+        await self._flush(self._take_pending())
+
+    async def _flush(self, batch: list):
+        texts = [text for request_texts, _ in batch for text in request_texts]
+        try:
+            # One model call at a time, the model uses all cores (or the GPU) by itself
+            async with self.model_lock:
+                # In a context of its own, the embed span of the model call belongs to the whole
+                # batch and not to the test case of the request that started the flush
+                start = time.perf_counter()
+                # A single large request is split too, so that no model call exceeds max_batch_size texts
+                vectors = np.concatenate([
+                    np.asarray(
+                        await asyncio.to_thread(contextvars.Context().run, self.embedding_function, texts[offset:offset + self.max_batch_size]),
+                        dtype=np.float32
+                    )
+                    for offset in range(0, len(texts), self.max_batch_size)
+                ])
+                model_seconds = round(time.perf_counter() - start, 6)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        offset = 0
+        for request_texts, future in batch:
+            if not future.done():
+                future.set_result((vectors[offset:offset + len(request_texts)], model_seconds))
+            offset += len(request_texts)
+
+class AnswerService:
+    # Keeps the embedding model, the chunking worker processes and the LLM engine loaded
+    # between requests. Every request gets an in-memory exact vector store of its own pages
+    def __init__(self):
+        self.embedding_function = get_embedding_function(EMBED_MODEL)
+        self.batcher = EmbeddingBatcher(self.embedding_function)
+        self.executor = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        self.engine = LLMEngine(async_llm, MAX_CONCURRENCY, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+        self.item_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        self.retrieval_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def warm_up(self):
+        # Loads the model and starts the worker processes before the first request
+        await self.batcher.embed(["warm up"])
+        await asyncio.wrap_future(self.executor.submit(split_page_timed, "<p>warm up</p>", CHUNK_SIZE, CHUNK_OVERLAP))
+
+    async def build_store(self, interaction_id: str, search_results: List[Dict], reuse_text: bool) -> NumpyStore:
+        loop = asyncio.get_running_loop()
+
+        with span("preprocess", pages=len(search_results)):
+            pages = await asyncio.gather(*[
+                loop.run_in_executor(
+                    self.executor,
+                    split_page_timed,
+                    result.get('page_result') or "",
+                    CHUNK_SIZE,
+                    CHUNK_OVERLAP,
+                    (interaction_id, str(result.get('page_url'))) if reuse_text else None
+                )
+                for result in search_results
+            ])
+
+        documents = []
+        ids = []
+        metadatas = []
+        for result, (chunks, timings) in zip(search_results, pages):
+            for name, timing in timings.items():
+                record(name, **timing)
+            for chunk_id, chunk in enumerate(chunks):
+                documents.append(chunk)
+                ids.append(f"{str(result.get('page_url'))}_{interaction_id}_{chunk_id}")
+                metadatas.append({"page_name": str(result.get('page_name')), "page_url": str(result.get('page_url'))})
+
+        store = NumpyStore("", None, DISTANCE_METRIC)
+        if documents:
+            store.add_vectors(await self.batcher.embed(documents), documents, metadatas, ids)
+        return store
+
+    async def search(self, store: NumpyStore, queries: List[str], n_results: int) -> List[List[Dict]]:
+        query_vectors = await self.batcher.embed(queries)
+        with span("search", queries=len(queries)):
+            return store.search(query_vectors, n_results)
+
+    async def retrieve(self, store: NumpyStore, query: str, use_pre_retrieval: bool) -> List[Dict]:
+        # Same retrieval as generate_contexts.py
+        if not use_pre_retrieval:
+            return (await self.search(store, [query], SIMILARITY_TOP_K))[0]
+
+        with span("pre_retrieval"):
+            response = await self.engine.create(model=MODEL_NAME, temperature=TEMPERATURE, messages=build_queries_messages(query))
+        queries = response.choices[0].message.content.strip().split("\n")[:4]
+
+        all_results = {}
+        results_by_id = {}
+        for generated_query, query_results in zip(queries, await self.search(store, queries, SIMILARITY_TOP_K)):
+            all_results[generated_query] = {result["id"]: result["score"] for result in query_results}
+            results_by_id.update({result["id"]: result for result in query_results})
+
+        return [results_by_id[chunk_id] for chunk_id in list(reciprocal_rank_fusion(all_results).keys())[:SIMILARITY_TOP_K]]
+
+    async def answer(self, request: Dict) -> Dict:
+        use_pre_retrieval = request.get("use_pre_retrieval", USE_PRE_RETRIEVAL)
+        use_cot = request.get("use_cot", USE_COT)
+        use_rig = request.get("use_rig", USE_RIG)
+        # Page text is only reused across requests when the caller identifies the pages
+        interaction_id = request.get("interaction_id")
+        reuse_text = interaction_id is not None
+        interaction_id = str(interaction_id or uuid.uuid4())
+
+        with trace_item(interaction_id) as item_trace:
+            store = await self.build_store(interaction_id, request.get("search_results", []), reuse_text)
+            results = await self.retrieve(store, request["query"], use_pre_retrieval)
+            contexts = pack_contexts([result["document"] for result in results], [result["id"] for result in results])
+
+            answer = await generate_answer_async(contexts, request["query"], self.engine, use_cot)
+            response = {"answer": answer, "context_ids": [result["id"] for result in results]}
+
+            if use_rig:
+                async def retrieve_results(generated_queries: List[str]) -> List[List[Dict]]:
+                    return await self.search(store, generated_queries, SIMILARITY_TOP_K)
+
+                rig_item = await process_item_async(
+                    {
+                        "id": interaction_id,
+                        "query": request["query"],
+                        "ground_truth": None,
+                        "answer": answer,
+                        "contexts": [result["document"] for result in results],
+                        "context_ids": [result["id"] for result in results]
+                    },
+                    self.engine,
+                    self.item_semaphore,
+                    self.retrieval_semaphore,
+                    retrieve_results
+                )
+                response["answer"] = rig_item["new_answer"]
+                response["details_verification"] = rig_item["details_verification"]
+
+        latency = {}
+        for span_record in item_trace["spans"]:
+            latency[span_record["name"]] = round(latency.get(span_record["name"], 0) + span_record["seconds"], 6)
+        response["latency"] = {"total": item_trace["seconds"], **latency}
+        return response
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[tuple]:
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get("content-length", 0))
+    if length > MAX_REQUEST_BYTES:
+        raise ValueError(f"Request of {length} bytes is larger than {MAX_REQUEST_BYTES}")
+    body = await reader.readexactly(length) if length else b""
+    return method, path, body
+
+async def write_response(writer: asyncio.StreamWriter, status: str, payload: Dict):
+    body = json.dumps(payload).encode("utf-8")
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1")
+        + body
+    )
+    await writer.drain()
+
+def make_handler(service: AnswerService):
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await read_request(reader)
+            if request is None:
+                return
+            method, path, body = request
+
+            if method == "GET" and path == "/health":
+                await write_response(writer, "200 OK", {"status": "ok"})
+            elif method == "POST" and path == "/answer":
+                start = time.perf_counter()
+                response = await service.answer(json.loads(body))
+                print(f"Answered in {time.perf_counter() - start:.2f}s: {response['answer']}")
+                await write_response(writer, "200 OK", response)
+            else:
+                await write_response(writer, "404 Not Found", {"error": f"Unknown endpoint {method} {path}"})
+        except (ValueError, KeyError) as e:
+            await write_response(writer, "400 Bad Request", {"error": str(e)})
+        except Exception as e:
+            print(f"Failed to answer request: {str(e)}")
+            await write_response(writer, "500 Internal Server Error", {"error": str(e)})
+        finally:
+            writer.close()
+
+    return handle
+
+async def serve(host: str = SERVE_HOST, port: int = SERVE_PORT):
+    start_trace("serve")
+    service = AnswerService()
+    await service.warm_up()
+
+    server = await asyncio.start_server(make_handler(service), host, port)
+    print(f"Serving on http://{host}:{port}, POST /answer with {{\"query\": ..., \"search_results\": [...]}}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    asyncio.run(serve(port=int(sys.argv[1]) if len(sys.argv) > 1 else SERVE_PORT))
@@ -0,0 +1,81 @@
+from crag_index import read_items
+from preprocess import page_key, split_page
+from retriever import (
+    EMBED_MODEL, CHUNK_SIZE, CHUNK_OVERLAP, DISTANCE_METRIC, CASCADE_FIRST_TIER, CASCADE_FIRST_TIER_MODEL, CASCADE_CANDIDATES,
+    get_embedding_function
+)
+from vector_store import BM25Store, CascadeStore, NumpyStore
+import sys
+import time
+
+def timed_embedding_function(embedding_function, timings: dict, name: str):
+    def embed(texts):
+        start = time.perf_counter()
+        vectors = embedding_function(texts)
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - start
+        timings[f"{name}_texts"] = timings.get(f"{name}_texts", 0) + len(texts)
+        return vectors
+    return embed
+
+def cascade_report(first_tier: str = CASCADE_FIRST_TIER, candidates: int = CASCADE_CANDIDATES, num_items: int = 300, k: int = 6):
+    # Retrieves the top-k chunks of each test case with EMBED_MODEL over all chunks and with the
+    # cascade, and reports the recall of the cascade and the indexing cost of both. The baseline
+    # embeddings normally come from the embedding cache of earlier runs, while the cascade's are
+    # timed without the cache; the baseline indexing time is estimated from the re-ranking throughput.
+    # The cascade indexing time includes building the BM25 term statistics, which BM25Store.add does
+    with open("random_nums.txt", "r") as f:
+        line_numbers = set(map(int, f.readlines()[:num_items]))
+
+    baseline_function = get_embedding_function(EMBED_MODEL)
+    timings = {}
+    rerank_function = timed_embedding_function(getattr(baseline_function, "embedding_function", baseline_function), timings, "rerank")
+    first_tier_function = None
+    if first_tier != "bm25":
+        first_tier_function = get_embedding_function(CASCADE_FIRST_TIER_MODEL)
+        first_tier_function = timed_embedding_function(getattr(first_tier_function, "embedding_function", first_tier_function), timings, "first_tier")
+
+    recalls = []
+    total_chunks = 0
+    index_seconds = 0.0
+
+    for line_number, item in read_items(line_numbers):
+        chunks = [
+            chunk
+            for page_index, result in enumerate(item['search_results'])
+            for chunk in split_page(result['page_result'], CHUNK_SIZE, CHUNK_OVERLAP, page_key(item, page_index))
+        ]
+        if not chunks:
+            continue
+        ids = [str(i) for i in range(len(chunks))]
+        metadatas = [{}] * len(chunks)
+
+        baseline = NumpyStore("", baseline_function, DISTANCE_METRIC)
+        baseline.add(chunks, metadatas, ids)
+        expected = {result["id"] for result in baseline.query([item['query']], k)[0]}
+
+        start = time.perf_counter()
+        first_tier_store = BM25Store("") if first_tier == "bm25" else NumpyStore("", first_tier_function, DISTANCE_METRIC)
+        cascade = CascadeStore(first_tier_store, rerank_function, DISTANCE_METRIC, candidates)
+        cascade.add(chunks, metadatas, ids)
+        index_seconds += time.perf_counter() - start
+        total_chunks += len(chunks)
+
+        retrieved = {result["id"] for result in cascade.query([item['query']], k)[0]}
+        recalls.append(len(expected & retrieved) / len(expected))
+        print(f"Test case {line_number}: recall@{k} {recalls[-1]:.2f}")
+
+    if not recalls:
+        return
+
+    print(f"Recall@{k} of the {first_tier} cascade with {candidates} candidates against {EMBED_MODEL} over {len(recalls)} test cases: {sum(recalls) / len(recalls):.4f}")
+    print(f"Cascade indexing: {index_seconds / len(recalls):.3f}s per test case for {total_chunks / len(recalls):.1f} chunks")
+    print(f"Re-ranking: {timings['rerank_texts'] / len(recalls):.1f} texts embedded with {EMBED_MODEL} per query in {timings['rerank'] / len(recalls):.3f}s")
+    if timings["rerank"] > 0:
+        baseline_seconds = total_chunks / (timings["rerank_texts"] / timings["rerank"]) / len(recalls)
+        print(f"Estimated indexing with {EMBED_MODEL} alone: {baseline_seconds:.3f}s per test case")
+
+if __name__ == "__main__":
+    first_tier = sys.argv[1] if len(sys.argv) > 1 else CASCADE_FIRST_TIER
+    candidates = int(sys.argv[2]) if len(sys.argv) > 2 else CASCADE_CANDIDATES
+    num_items = int(sys.argv[3]) if len(sys.argv) > 3 else 300
+    cascade_report(first_tier, candidates, num_items)
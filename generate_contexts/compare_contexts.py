@@ -0,0 +1,32 @@
+from typing import Dict, List
+import json
+import sys
+
+def load_context_ids(path: str) -> Dict[int, List[str]]:
+    context_ids = {}
+    with open(path, "r") as contexts_file:
+        for line in contexts_file:
+            item = json.loads(line)
+            # Files written before context_ids existed are compared by chunk text
+            context_ids[item["id"]] = item.get("context_ids") or item["contexts"]
+    return context_ids
+
+def recall_at_k(baseline_path: str, candidate_path: str, k: int = 6) -> float:
+    # Fraction of the baseline's top-k chunks that the candidate also retrieved in its top k
+    baseline = load_context_ids(baseline_path)
+    candidate = load_context_ids(candidate_path)
+
+    recalls = []
+    for item_id in baseline.keys() & candidate.keys():
+        expected = set(baseline[item_id][:k])
+        if expected:
+            recalls.append(len(expected & set(candidate[item_id][:k])) / len(expected))
+
+    return sum(recalls) / len(recalls) if recalls else 0
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        raise SystemExit("Usage: python3 compare_contexts.py <baseline contexts.jsonl> <candidate contexts.jsonl> [k]")
+
+    k = int(sys.argv[3]) if len(sys.argv) > 3 else 6
+    print(f"Recall@{k} of {sys.argv[2]} against {sys.argv[1]}: {recall_at_k(sys.argv[1], sys.argv[2], k):.4f}")
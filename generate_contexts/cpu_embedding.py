@@ -0,0 +1,95 @@
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from sentence_transformers import SentenceTransformer
+from typing import List, Optional, Sequence
+import numpy as np
+import time
+import torch
+
+# Token budgets per batch tried when tuning, the padded batch size is budget // longest text
+BATCH_TOKEN_CANDIDATES=(4096, 8192, 16384, 32768)
+TUNING_SAMPLE_SIZE=64
+TUNING_MIN_TEXTS=16
+
+class CPUEmbeddingFunction(EmbeddingFunction[Documents]):
+    # Texts are sorted by token length and batched so that every batch holds about the same number
+    # of tokens, which keeps padding small when short and 3072-token chunks are mixed. The token
+    # budget per batch is measured on the first call with enough texts unless max_batch_tokens is given.
+    # With quantize, the linear layers run as int8 with dynamically quantized activations
+    def __init__(
+        self,
+        model_name: str,
+        quantize: bool = False,
+        max_batch_tokens: Optional[int] = None,
+        num_threads: Optional[int] = None
+    ):
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.model.eval()
+        if quantize:
+            torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+        self.max_batch_tokens = max_batch_tokens
+
+    def token_lengths(self, texts: Sequence[str]) -> List[int]:
+        input_ids = self.model.tokenizer(
+            list(texts),
+            truncation=True,
+            max_length=self.model.max_seq_length
+        )["input_ids"]
+        return [len(ids) for ids in input_ids]
+
+    @staticmethod
+    def length_buckets(lengths: Sequence[int], max_batch_tokens: int) -> List[List[int]]:
+        # Indices sorted by length, split whenever the padded batch would exceed the budget
+        buckets = []
+        bucket = []
+        for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            if bucket and (len(bucket) + 1) * lengths[index] > max_batch_tokens:
+                buckets.append(bucket)
+                bucket = []
+            bucket.append(index)
+
+        if bucket:
+            buckets.append(bucket)
+        return buckets
+
+    def encode(self, texts: Sequence[str], max_batch_tokens: int, lengths: Optional[Sequence[int]] = None) -> np.ndarray:
+        lengths = lengths if lengths is not None else self.token_lengths(texts)
+        embeddings = None
+
+        with torch.inference_mode():
+            for bucket in self.length_buckets(lengths, max_batch_tokens):
+                vectors = self.model.encode(
+                    [texts[i] for i in bucket],
+                    batch_size=len(bucket),
+                    convert_to_numpy=True,
+                    show_progress_bar=False
+                )
+                if embeddings is None:
+                    embeddings = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+                embeddings[bucket] = vectors
+
+        return embeddings
+
+    def tune(self, texts: Sequence[str]) -> int:
+        # Picks the token budget with the highest throughput on a sample of the texts
+        sample = list(texts[:TUNING_SAMPLE_SIZE])
+        lengths = self.token_lengths(sample)
+        self.encode(sample[:1], BATCH_TOKEN_CANDIDATES[0], lengths[:1])  # Warm-up
+
+        throughputs = {}
+        for max_batch_tokens in BATCH_TOKEN_CANDIDATES:
+            start = time.perf_counter()
+            self.encode(sample, max_batch_tokens, lengths)
+            throughputs[max_batch_tokens] = sum(lengths) / (time.perf_counter() - start)
+
+        self.max_batch_tokens = max(throughputs, key=throughputs.get)
+        print(f"CPU embedding: {self.max_batch_tokens} tokens per batch ({throughputs[self.max_batch_tokens]:.0f} tokens/s)")
+        return self.max_batch_tokens
+
+    def __call__(self, input: Documents) -> Embeddings:
+        if self.max_batch_tokens is None and len(input) >= TUNING_MIN_TEXTS:
+            self.tune(input)
+        return self.encode(input, self.max_batch_tokens or BATCH_TOKEN_CANDIDATES[-1]).tolist()
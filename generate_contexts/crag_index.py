@@ -0,0 +1,74 @@
+from typing import Dict, Iterable, Iterator, Tuple
+import bz2
+import json
+import os
+import zlib
+
+CRAG_PATH="crag_task_3_dev_v4.jsonl.bz2"
+BLOCKS_SUFFIX=".blocks"
+INDEX_SUFFIX=".blocks.idx"
+COMPRESSION_LEVEL=6
+
+def build_index(source_path: str = CRAG_PATH):
+    # bz2 blocks are bit-aligned and cannot be seeked into directly, so every line is
+    # recompressed once into its own zlib block and its offset recorded in the index
+    blocks_path = source_path + BLOCKS_SUFFIX
+    index_path = source_path + INDEX_SUFFIX
+    offsets = []
+
+    with bz2.open(source_path, "rb") as input_file, \
+         open(blocks_path + ".tmp", "wb") as blocks_file:
+
+        for line_number, line in enumerate(input_file):
+            block = zlib.compress(line, COMPRESSION_LEVEL)
+            offsets.append([blocks_file.tell(), len(block)])
+            blocks_file.write(block)
+
+            if (line_number + 1) % 100 == 0:
+                print(f"Indexed {line_number + 1} lines of {source_path}")
+
+    os.replace(blocks_path + ".tmp", blocks_path)
+
+    source_stat = os.stat(source_path)
+    index = {
+        "source_size": source_stat.st_size,
+        "source_mtime": source_stat.st_mtime,
+        "offsets": offsets
+    }
+
+    with open(index_path + ".tmp", "w") as index_file:
+        json.dump(index, index_file)
+    os.replace(index_path + ".tmp", index_path)
+
+    print(f"Indexing completed. {len(offsets)} lines stored in {blocks_path}")
+
+def load_index(source_path: str = CRAG_PATH) -> list:
+    index_path = source_path + INDEX_SUFFIX
+
+    if os.path.exists(index_path):
+        with open(index_path, "r") as index_file:
+            index = json.load(index_file)
+
+        source_stat = os.stat(source_path)
+        if index["source_size"] == source_stat.st_size and index["source_mtime"] == source_stat.st_mtime:
+            return index["offsets"]
+
+        print(f"Index of {source_path} is stale, rebuilding")
+
+    build_index(source_path)
+    return load_index(source_path)
+
+def read_items(line_numbers: Iterable[int], source_path: str = CRAG_PATH) -> Iterator[Tuple[int, Dict]]:
+    offsets = load_index(source_path)
+
+    with open(source_path + BLOCKS_SUFFIX, "rb") as blocks_file:
+        for line_number in sorted(set(line_numbers)):
+            if line_number >= len(offsets):
+                raise IndexError(f"Line {line_number} is out of range, {source_path} has {len(offsets)} lines")
+
+            offset, length = offsets[line_number]
+            blocks_file.seek(offset)
+            yield line_number, json.loads(zlib.decompress(blocks_file.read(length)))
+
+if __name__ == "__main__":
+    build_index()
@@ -0,0 +1,126 @@
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from typing import Dict, List
+import fcntl
+import hashlib
+import json
+import numpy as np
+import os
+import re
+import threading
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    # Vectors of one model are appended to a raw float32 file that is read back through a
+    # memory map; index.txt holds the text hash of every row in the same order
+    def __init__(self, model_key: str, path: str):
+        self.model_key = model_key
+        self.directory = os.path.join(path, re.sub(r"[^A-Za-z0-9_.-]+", "_", model_key))
+        self.vectors_path = os.path.join(self.directory, "vectors.f32")
+        self.index_path = os.path.join(self.directory, "index.txt")
+        self.meta_path = os.path.join(self.directory, "meta.json")
+        self.lock_path = os.path.join(self.directory, ".lock")
+
+        self.dim = None
+        self.rows: Dict[str, int] = {}
+        self.index_offset = 0
+        self.vectors = None
+        self.lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock, open(self.lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._refresh()
+
+            # Drop vectors written by an interrupted process without an index entry
+            if self.dim is not None and os.path.exists(self.vectors_path):
+                os.truncate(self.vectors_path, len(self.rows) * self.dim * 4)
+
+    def _refresh(self):
+        if self.dim is None and os.path.exists(self.meta_path):
+            with open(self.meta_path, "r") as meta_file:
+                self.dim = json.load(meta_file)["dim"]
+
+        if not os.path.exists(self.index_path):
+            return
+
+        # Pick up rows appended by other processes since the last read
+        with open(self.index_path, "r") as index_file:
+            index_file.seek(self.index_offset)
+            for line in index_file:
+                if not line.endswith("\n"):
+                    break
+                self.rows.setdefault(line.strip(), len(self.rows))
+                self.index_offset += len(line)
+
+    def _vector_matrix(self) -> np.ndarray:
+        if self.vectors is None or self.vectors.shape[0] < len(self.rows):
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(len(self.rows), self.dim))
+        return self.vectors
+
+    def get(self, hashes: List[str]) -> Dict[str, List[float]]:
+        with self.lock:
+            if any(h not in self.rows for h in hashes):
+                self._refresh()
+
+            found = [h for h in hashes if h in self.rows]
+            if not found:
+                return {}
+
+            vectors = self._vector_matrix()
+            return {h: vectors[self.rows[h]].tolist() for h in found}
+
+    def put(self, hashes: List[str], embeddings: List[List[float]]):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+
+        with self.lock, open(self.lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._refresh()
+
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self.meta_path, "w") as meta_file:
+                    json.dump({"model": self.model_key, "dim": self.dim}, meta_file)
+
+            new_rows = [i for i, h in enumerate(hashes) if h not in self.rows]
+            if not new_rows:
+                return
+
+            with open(self.vectors_path, "ab") as vectors_file:
+                vectors_file.write(vectors[new_rows].tobytes())
+                vectors_file.flush()
+                os.fsync(vectors_file.fileno())
+
+            with open(self.index_path, "a") as index_file:
+                for i in new_rows:
+                    index_file.write(hashes[i] + "\n")
+
+            self._refresh()
+
+class CachedEmbeddingFunction(EmbeddingFunction[Documents]):
+    def __init__(self, embedding_function: EmbeddingFunction, model_key: str, cache_path: str):
+        self.embedding_function = embedding_function
+        self.cache = EmbeddingCache(model_key, cache_path)
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, input: Documents) -> Embeddings:
+        hashes = [text_hash(text) for text in input]
+        embeddings = self.cache.get(hashes)
+
+        # Only texts never embedded before go through the model
+        missing = {}
+        for h, text in zip(hashes, input):
+            if h not in embeddings:
+                missing.setdefault(h, text)
+
+        self.hits += len(hashes) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            new_embeddings = self.embedding_function(list(missing.values()))
+            self.cache.put(list(missing.keys()), new_embeddings)
+            embeddings.update(zip(missing.keys(), np.asarray(new_embeddings, dtype=np.float32).tolist()))
+
+        return [embeddings[h] for h in hashes]
@@ -0,0 +1,56 @@
+from crag_index import read_items
+from preprocess import page_key, split_page
+from retriever import EMBED_MODEL, CHUNK_SIZE, CHUNK_OVERLAP, EMBEDDING_BACKEND, get_embedding_function
+from typing import List
+import numpy as np
+import sys
+import time
+
+def top_k(embedding_function, query: str, chunks: List[str], k: int) -> List[int]:
+    vectors = np.asarray(embedding_function([query] + chunks), dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    return np.argsort(-(vectors[1:] @ vectors[0]))[:k].tolist()
+
+def embedding_parity(backend: str, num_items: int = 300, k: int = 6):
+    # Retrieves the top-k chunks of each test case with the full-precision model and the given
+    # backend, and reports how many of the full-precision chunks the backend retrieves as well.
+    # The full-precision embeddings normally come from the embedding cache of earlier runs
+    with open("random_nums.txt", "r") as f:
+        line_numbers = set(map(int, f.readlines()[:num_items]))
+
+    baseline = get_embedding_function(EMBED_MODEL, "sentence-transformers")
+    # Measured without the embedding cache so that the throughput is the model's own
+    candidate = get_embedding_function(EMBED_MODEL, backend)
+    candidate = getattr(candidate, "embedding_function", candidate)
+
+    recalls = []
+    candidate_chunks = 0
+    candidate_seconds = 0.0
+
+    for line_number, item in read_items(line_numbers):
+        chunks = [
+            chunk
+            for page_index, result in enumerate(item['search_results'])
+            for chunk in split_page(result['page_result'], CHUNK_SIZE, CHUNK_OVERLAP, page_key(item, page_index))
+        ]
+        if not chunks:
+            continue
+
+        expected = set(top_k(baseline, item['query'], chunks, k))
+
+        start = time.perf_counter()
+        retrieved = set(top_k(candidate, item['query'], chunks, k))
+        candidate_seconds += time.perf_counter() - start
+        candidate_chunks += len(chunks)
+
+        recalls.append(len(expected & retrieved) / len(expected))
+        print(f"Test case {line_number}: recall@{k} {recalls[-1]:.2f}")
+
+    print(f"Recall@{k} of {backend} against full precision over {len(recalls)} test cases: {sum(recalls) / max(len(recalls), 1):.4f}")
+    if candidate_seconds > 0:
+        print(f"{backend} embedded {candidate_chunks / candidate_seconds:.2f} chunks/s")
+
+if __name__ == "__main__":
+    backend = sys.argv[1] if len(sys.argv) > 1 else EMBEDDING_BACKEND
+    num_items = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+    embedding_parity(backend, num_items)
@@ -0,0 +1,92 @@
+from crag_index import read_items
+from html_extraction import EXTRACTION_ENGINES, extract_page_text
+from preprocess import get_sentence_splitter
+from retriever import EMBED_MODEL, CHUNK_SIZE, CHUNK_OVERLAP, DISTANCE_METRIC, get_embedding_function
+from vector_store import NumpyStore
+import sys
+import time
+
+# A standings table inside <main> whose team names are links, the kind of entity CRAG finance and
+# sports questions ask about; every engine should keep the names along with the numbers
+LINKED_TABLE_PAGE=(
+    "<html><body><nav><ul><li><a href='/'>Home</a></li><li><a href='/scores'>Scores</a></li></ul></nav><main>"
+    "<h2>2022 standings</h2><table><tr><th>Team</th><th>W</th><th>L</th></tr>"
+    "<tr><td><a href='/celtics'>Boston Celtics</a></td><td>33</td><td>49</td></tr>"
+    "<tr><td><a href='/heat'>Miami Heat</a></td><td>51</td><td>31</td></tr></table></main></body></html>"
+)
+LINKED_TABLE_TEXTS=["Boston Celtics", "Miami Heat", "33", "51"]
+
+def check_linked_table(engines=EXTRACTION_ENGINES) -> dict:
+    kept = {}
+    for engine in engines:
+        text = normalize_answer(extract_page_text(LINKED_TABLE_PAGE, engine))
+        kept[engine] = all(normalize_answer(expected) in text for expected in LINKED_TABLE_TEXTS)
+    return kept
+
+def normalize_answer(text: str) -> str:
+    return " ".join(text.lower().split())
+
+def extraction_report(engines=EXTRACTION_ENGINES, num_items: int = 300, k: int = 6):
+    # For each engine: extraction throughput, text and chunks per page, and how often the ground
+    # truth is found in the extracted text and in the top-k chunks retrieved for the query. The
+    # answer is matched as a lowercase substring, so only test cases whose answer appears in some
+    # page's text under any engine are counted
+    for engine, kept in check_linked_table(engines).items():
+        print(f"{engine}: {'keeps' if kept else 'DROPS'} the linked cells of a table")
+
+    with open("random_nums.txt", "r") as f:
+        line_numbers = set(map(int, f.readlines()[:num_items]))
+
+    embedding_function = get_embedding_function(EMBED_MODEL)
+    splitter = get_sentence_splitter(CHUNK_SIZE, CHUNK_OVERLAP)
+    stats = {engine: {"seconds": 0.0, "html_bytes": 0, "text_chars": 0, "chunks": 0, "in_text": 0, "in_top_k": 0} for engine in engines}
+    pages = 0
+    answerable = 0
+
+    for line_number, item in read_items(line_numbers):
+        answer = normalize_answer(item['answer'])
+        html_pages = [result['page_result'] or "" for result in item['search_results']]
+        pages += len(html_pages)
+
+        texts = {}
+        for engine in engines:
+            start = time.perf_counter()
+            texts[engine] = [extract_page_text(html, engine) for html in html_pages]
+            stats[engine]["seconds"] += time.perf_counter() - start
+            stats[engine]["html_bytes"] += sum(len(html.encode("utf-8")) for html in html_pages)
+            stats[engine]["text_chars"] += sum(map(len, texts[engine]))
+
+        found = {engine: any(answer in normalize_answer(text) for text in texts[engine]) for engine in engines}
+        if not answer or answer in ("yes", "no", "invalid question") or not any(found.values()):
+            for engine in engines:
+                stats[engine]["chunks"] += sum(len(splitter.split_text(text)) for text in texts[engine])
+            continue
+        answerable += 1
+
+        for engine in engines:
+            chunks = [chunk for text in texts[engine] for chunk in splitter.split_text(text)]
+            stats[engine]["chunks"] += len(chunks)
+            stats[engine]["in_text"] += found[engine]
+            if not chunks:
+                continue
+
+            store = NumpyStore("", embedding_function, DISTANCE_METRIC)
+            store.add(chunks, [{}] * len(chunks), [str(i) for i in range(len(chunks))])
+            retrieved = store.query([item['query']], k)[0]
+            stats[engine]["in_top_k"] += any(answer in normalize_answer(result["document"]) for result in retrieved)
+
+        print(f"Test case {line_number}: " + ", ".join(f"{engine} {'found' if found[engine] else 'missed'}" for engine in engines))
+
+    print(f"\n{pages} pages, {answerable} test cases with the answer in the text of a page")
+    for engine in engines:
+        engine_stats = stats[engine]
+        print(
+            f"{engine}: {engine_stats['html_bytes'] / max(engine_stats['seconds'], 1e-9) / 1024 ** 2:.1f} MB/s, "
+            f"{engine_stats['text_chars'] / max(pages, 1):.0f} characters and {engine_stats['chunks'] / max(pages, 1):.2f} chunks per page, "
+            f"answer in text {engine_stats['in_text'] / max(answerable, 1):.2%}, in top {k} chunks {engine_stats['in_top_k'] / max(answerable, 1):.2%}"
+        )
+
+if __name__ == "__main__":
+    num_items = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    engines = sys.argv[2:] or EXTRACTION_ENGINES
+    extraction_report(engines, num_items)
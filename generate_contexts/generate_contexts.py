@@ -1,160 +1,277 @@
 from llm_config import *
-from llama_index.core.node_parser import SentenceSplitter
-from bs4 import BeautifulSoup
+from crag_index import read_items
+from preprocess import PREPROCESS_LOOKAHEAD, page_key, preprocess_items, split_page_timed
+from page_ranking import rank_pages
+from retriever import (
+    EMBED_MODEL, CHUNK_SIZE, CHUNK_OVERLAP, DISTANCE_METRIC, MATRYOSHKA_DIM, MATRYOSHKA_RERANK_FACTOR,
+    LAZY_INDEXING, LAZY_PAGE_SCORER, LAZY_INITIAL_PAGES, LAZY_EXPAND_PAGES, LAZY_SCORE_THRESHOLD,
+    CASCADE_RETRIEVAL, CASCADE_CANDIDATES,
+    collection_name, index_params, get_embedding_function, list_collection_names, get_collection, create_collection, query_collection
+)
+from common.chunk_store import put_chunks
+from common.resume import open_output
+from common.tracing import finish_trace, record, span, start_trace, trace_item
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
-import chromadb
-import bz2
 import json
-import chromadb.utils.embedding_functions
-import torch
+import os
+import time
 
-EMBED_MODEL="model/dunzhang/stella_en_1.5B_v5"
-CHUNK_SIZE=3072
-CHUNK_OVERLAP=int(0.2 * CHUNK_SIZE)
 SIMILARITY_TOP_K=6
-DISTANCE_METRIC="cosine"
+ADD_BATCH_SIZE=32
+# Results refer to chunks in common/chunk_store.py by key instead of carrying their text
+COMPACT_CONTEXTS=True
+# With pre-retrieval, queries are generated in threads for the items in the preprocessing
+# look-ahead window while the current item is indexed
+QUERY_EXPANSION_WORKERS=PREPROCESS_LOOKAHEAD + 1
 
-def generate_queries(query: str, num_queries: int = 4) -> List[str]:
+def build_queries_messages(query: str, num_queries: int = 4) -> list:
     system_prompt = "Generate multiple search queries based on the input query. Be specific and diverse."
     user_prompt = f"Generate {num_queries} different search queries related to: {query}"
 
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def generate_queries(query: str, num_queries: int = 4) -> List[str]:
     response = llm.chat.completions.create(
         model=MODEL_NAME,
         temperature=TEMPERATURE,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt}
-        ]
+        messages=build_queries_messages(query, num_queries)
     )
 
     queries = response.choices[0].message.content.strip().split("\n")
     return queries[:num_queries]
 
+def generate_queries_traced(query: str) -> List[str]:
+    # Runs in a background thread, so the span counts towards the summary but not the test case
+    with span("pre_retrieval"):
+        return generate_queries(query)
+
 def reciprocal_rank_fusion(search_results_dict: Dict[str, Dict[str, float]], k: int = 60) -> Dict[str, float]:
     fused_scores = {}
 
-    for _, doc_scores in search_results_dict.items():
-        for rank, (doc, _) in enumerate(sorted(doc_scores.items(), key=lambda x: x[1], reverse=True)):
-            if doc not in fused_scores:
-                fused_scores[doc] = 0
-            fused_scores[doc] += 1 / (rank + k)
+    for _, chunk_scores in search_results_dict.items():
+        for rank, (chunk_id, _) in enumerate(sorted(chunk_scores.items(), key=lambda x: x[1], reverse=True)):
+            if chunk_id not in fused_scores:
+                fused_scores[chunk_id] = 0
+            fused_scores[chunk_id] += 1 / (rank + k)
     
     return dict(sorted(fused_scores.items(), key=lambda x: x[1], reverse=True))
 
-def generate_contexts(embed_model, chunk_size, chunk_overlap, similarity_top_k, distance_metric, use_pre_retrieval: bool = False):
-    db = chromadb.PersistentClient(path="chromadb")
+def read_items_traced(line_numbers):
+    # Reads are timed one test case at a time; they run ahead of the test case being indexed
+    items = read_items(line_numbers)
+    while True:
+        start = time.perf_counter()
+        item = next(items, None)
+        if item is None:
+            return
+        record("read", time.perf_counter() - start)
+        yield item
+
+def expand_queries_ahead(items, query_executor: ThreadPoolExecutor, query_futures: Dict):
+    # preprocess_items reads its look-ahead window from this generator, so query generation
+    # starts when an item enters the window
+    for line_number, item in items:
+        query_futures[line_number] = query_executor.submit(generate_queries_traced, item['query'])
+        yield line_number, item
+
+def wait_for_chunks(chunks_future):
+    with span("preprocess_wait"):
+        return chunks_future.result()
+
+def record_chunks(page_index: int, chunks_and_timings):
+    # The durations and sizes of parsing and chunking are measured by split_page_timed
+    chunks, timings = chunks_and_timings
+    for name, timing in timings.items():
+        record(name, **timing)
+    return page_index, chunks
+
+def add_pages(collection, item: Dict, pages):
+    # pages yields (page_index, chunks) pairs
+    documents = []
+    metadatas = []
+    ids = []
+    for page_index, chunks in pages:
+        result = item['search_results'][page_index]
+
+        for chunk_id, chunk in enumerate(chunks):
+            documents.append(chunk)
+            metadatas.append({
+                "page_name": str(result['page_name']),
+                "page_url": str(result['page_url']),
+                "page_last_modified": str(result['page_last_modified']),
+                "interaction_id": str(item['interaction_id'])
+            })
+            ids.append(f"{str(result['page_url'])}_{str(item['interaction_id'])}_{chunk_id}")
 
+        if len(documents) >= ADD_BATCH_SIZE:
+            # The model time of the chunks is the nested index_add/embed span, the rest the store insert
+            with span("index_add", chunks=len(documents)):
+                collection.add(documents=documents, metadatas=metadatas, ids=ids)
+            documents, metadatas, ids = [], [], []
+
+    if documents:
+        with span("index_add", chunks=len(documents)):
+            collection.add(
+                documents=documents,
+                metadatas=metadatas,
+                ids=ids
+            )
+
+def expand_lazy_collection(collection, item: Dict, page_order: List[int], chunk_size: int, chunk_overlap: int) -> int:
+    # Index more pages while retrieval for the query finds nothing similar enough
+    indexed_pages = LAZY_INITIAL_PAGES
+    while indexed_pages < len(page_order):
+        with span("query", queries=1):
+            query_results = query_collection(collection, [item['query']], 1)[0]
+        if query_results and query_results[0]["score"] >= LAZY_SCORE_THRESHOLD:
+            break
+
+        next_pages = page_order[indexed_pages:indexed_pages + LAZY_EXPAND_PAGES]
+        add_pages(collection, item, (
+            record_chunks(page_index, split_page_timed(
+                item['search_results'][page_index]['page_result'], chunk_size, chunk_overlap, page_key(item, page_index)
+            ))
+            for page_index in next_pages
+        ))
+        indexed_pages += len(next_pages)
+
+    return min(indexed_pages, len(page_order))
+
+def generate_contexts(embed_model, chunk_size, chunk_overlap, similarity_top_k, distance_metric, use_pre_retrieval: bool = False):
     with open("random_nums.txt", "r") as f:
         random_nums = set(map(int, f.readlines()[:300]))
 
-    generated = 0
-    
     output_path = "../results/contexts_with_pre-retrieval.jsonl" if use_pre_retrieval else "../results/contexts_without_pre-retrieval.jsonl"
 
-    with bz2.open("crag_task_3_dev_v4.jsonl.bz2", "r") as input_file, \
-         open(output_path, "w") as output_file:
+    output_file, done_ids = open_output(output_path, {
+        "stage": "contexts",
+        "similarity_top_k": similarity_top_k,
+        "index": index_params(embed_model, chunk_size, chunk_overlap, distance_metric),
+        "cascade_candidates": CASCADE_CANDIDATES if CASCADE_RETRIEVAL else None,
+        "matryoshka_rerank_factor": MATRYOSHKA_RERANK_FACTOR if MATRYOSHKA_DIM else None,
+        "use_pre_retrieval": use_pre_retrieval,
+        "model_name": MODEL_NAME if use_pre_retrieval else None,
+        "temperature": TEMPERATURE if use_pre_retrieval else None
+    })
+    start_trace(os.path.splitext(os.path.basename(output_path))[0], resume=bool(done_ids))
+    generated = len(done_ids)
+
+    existing_collections = list_collection_names()
+    page_orders = {}
+
+    def select_pages(line_number: int, item: Dict):
+        if collection_name(line_number, embed_model, chunk_size, chunk_overlap, distance_metric) in existing_collections:
+            return None
+        if not LAZY_INDEXING:
+            return list(range(len(item['search_results'])))
+
+        page_orders[line_number] = rank_pages(
+            item['query'],
+            item['search_results'],
+            LAZY_PAGE_SCORER,
+            get_embedding_function(embed_model) if LAZY_PAGE_SCORER == "embedding" else None
+        )
+        return page_orders[line_number][:LAZY_INITIAL_PAGES]
+
+    query_executor = ThreadPoolExecutor(max_workers=QUERY_EXPANSION_WORKERS)
+    query_futures = {}
+    items = read_items_traced(random_nums - done_ids)
+    if use_pre_retrieval:
+        items = expand_queries_ahead(items, query_executor, query_futures)
+
+    items = preprocess_items(
+        items,
+        chunk_size,
+        chunk_overlap,
+        select_pages
+    )
+
+    total_pages = 0
+    indexed_pages = 0
+
+    with query_executor, output_file:
         
-        for line_number, line in enumerate(input_file):
-            if line_number not in random_nums:
-                continue
-
-            item = json.loads(line)
-
-            collection_params = {
-                "name": f"collection_{line_number}",
-                "embedding_function": chromadb.utils.embedding_functions.SentenceTransformerEmbeddingFunction(
-                    model_name=embed_model,
-                    device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
-                )
-            }
-
-            try:
-                chroma_collection = db.get_collection(**collection_params)
-            except Exception:
-                if distance_metric != "l2":
-                    collection_params["metadata"] = {"hnsw:space": distance_metric}
-
-                chroma_collection = db.create_collection(**collection_params)
-
-                sentence_splitter = SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-
-                documents = []
-                metadatas = []
-                ids = []
-                for result in item['search_results']:
-                    soup = BeautifulSoup(result['page_result'], 'html.parser')
-                    text = soup.get_text(separator=' ', strip=True)
-                    
-                    chunks = sentence_splitter.split_text(text)
-                    
-                    for chunk_id, chunk in enumerate(chunks):
-                        documents.append(chunk)
-                        metadatas.append({
-                            "page_name": str(result['page_name']),
-                            "page_url": str(result['page_url']),
-                            "page_last_modified": str(result['page_last_modified']),
-                            "interaction_id": str(item['interaction_id'])
-                        })
-                        ids.append(f"{str(result['page_url'])}_{str(item['interaction_id'])}_{chunk_id}")
-                
-                chroma_collection.add(
-                    documents=documents,
-                    metadatas=metadatas,
-                    ids=ids
-                )
+        for line_number, item, page_chunks in items:
+            with trace_item(line_number):
+                if page_chunks is None:
+                    collection = get_collection(line_number, embed_model, chunk_size, chunk_overlap, distance_metric)
+                else:
+                    collection = create_collection(line_number, embed_model, chunk_size, chunk_overlap, distance_metric)
+
+                    # Chunks are added page by page as the worker processes finish them
+                    add_pages(collection, item, (
+                        record_chunks(page_index, wait_for_chunks(chunks_future)) for page_index, chunks_future in page_chunks
+                    ))
+
+                    if LAZY_INDEXING:
+                        item_indexed_pages = expand_lazy_collection(collection, item, page_orders.pop(line_number), chunk_size, chunk_overlap)
+                        total_pages += len(item['search_results'])
+                        indexed_pages += item_indexed_pages
+                        print(f"Indexed {item_indexed_pages} of {len(item['search_results'])} pages for test case {line_number}")
+
+                    with span("persist"):
+                        collection.persist()
             
-            if use_pre_retrieval:
-                # Generate multiple queries
-                queries = generate_queries(item['query'])
-
-                # Get search results for each query
-                all_results = {}
-                for query in queries:
-                    query_results = chroma_collection.query(
-                        query_texts=[query],
-                        n_results=similarity_top_k,
-                        include=["documents", "distances"]
-                    )
-                    
-                    # Create score dictionary for this query's results
-                    scores_dict = {}
-                    for doc, distance in zip(query_results['documents'][0], query_results['distances'][0]):
-                        scores_dict[doc] = 1 - distance  # Convert distance to similarity score
-                    all_results[query] = scores_dict
-
-                # Combine results using reciprocal rank fusion
-                fused_results = reciprocal_rank_fusion(all_results)
-                
-                # Take top K contexts after fusion
-                contexts = list(fused_results.keys())[:similarity_top_k] if fused_results else [""]
-            else:
-                query_results = chroma_collection.query(
-                    query_texts=[item['query']],
-                    n_results=similarity_top_k,
-                    include=["documents"]
-                )
+                if use_pre_retrieval:
+                    # Multiple queries were generated while the collection was indexed
+                    with span("pre_retrieval_wait"):
+                        queries = query_futures.pop(line_number).result()
+
+                    # Get search results for all queries in one batch
+                    all_results = {}
+                    documents = {}
+                    with span("query", queries=len(queries)):
+                        queries_results = query_collection(collection, queries, similarity_top_k)
+                    for query, query_results in zip(queries, queries_results):
+                        all_results[query] = {result["id"]: result["score"] for result in query_results}
+                        documents.update({result["id"]: result["document"] for result in query_results})
+
+                    # Combine results using reciprocal rank fusion
+                    fused_results = reciprocal_rank_fusion(all_results)
                 
-                contexts = query_results['documents'][0] if query_results['documents'][0] else [""]
-            
-            contexts_item = {
-                "id": line_number,
-                "query": item['query'],
-                "ground_truth": item['answer'],
-                "contexts": contexts
-            }
-
-            output_file.write(json.dumps(contexts_item) + '\n')
-            output_file.flush()
-
-            generated += 1
-            use_pre_retrieval_status = "with pre-retrieval" if use_pre_retrieval else "without pre-retrieval"
-            print(f"Generated contexts {use_pre_retrieval_status} for {generated} test cases")
-
-            random_nums.remove(line_number)
-            if len(random_nums) == 0:
-                break
+                    # Take top K contexts after fusion
+                    context_ids = list(fused_results.keys())[:similarity_top_k]
+                    context_scores = [fused_results[chunk_id] for chunk_id in context_ids]
+                else:
+                    with span("query", queries=1):
+                        query_results = query_collection(collection, [item['query']], similarity_top_k)[0]
+
+                    context_ids = [result["id"] for result in query_results]
+                    context_scores = [result["score"] for result in query_results]
+                    documents = {result["id"]: result["document"] for result in query_results}
+
+                contexts_item = {
+                    "id": line_number,
+                    "query": item['query'],
+                    "ground_truth": item['answer'],
+                    "alt_ans": item.get('alt_ans', []),
+                    "context_ids": context_ids,
+                    "context_scores": context_scores
+                }
+                if COMPACT_CONTEXTS:
+                    with span("chunk_store"):
+                        contexts_item["context_keys"] = put_chunks([documents[chunk_id] for chunk_id in context_ids])
+                else:
+                    contexts_item["contexts"] = [documents[chunk_id] for chunk_id in context_ids] if context_ids else [""]
+
+                with span("write"):
+                    output_file.write(json.dumps(contexts_item) + '\n')
+                    output_file.flush()
+
+                generated += 1
+                use_pre_retrieval_status = "with pre-retrieval" if use_pre_retrieval else "without pre-retrieval"
+                print(f"Generated contexts {use_pre_retrieval_status} for {generated} test cases")
     
     print(f"Contexts generation completed. Results stored in {output_path}")
+    if total_pages > 0:
+        print(f"Lazy indexing: indexed {indexed_pages} of {total_pages} pages ({indexed_pages / total_pages:.2%})")
+    print(llm.cache_report())
+    print(finish_trace())
 
-use_pre_retrieval = input("Use pre-retrieval for contexts generation? (T/F): ").upper() == 'T'
-generate_contexts(EMBED_MODEL, CHUNK_SIZE, CHUNK_OVERLAP, SIMILARITY_TOP_K, DISTANCE_METRIC, use_pre_retrieval)
\ No newline at end of file
+if __name__ == "__main__":
+    use_pre_retrieval = input("Use pre-retrieval for contexts generation? (T/F): ").upper() == 'T'
+    generate_contexts(EMBED_MODEL, CHUNK_SIZE, CHUNK_OVERLAP, SIMILARITY_TOP_K, DISTANCE_METRIC, use_pre_retrieval)
\ No newline at end of file
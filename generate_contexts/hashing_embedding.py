@@ -0,0 +1,21 @@
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+import numpy as np
+import re
+import zlib
+
+HASHING_DIM=1024
+
+class HashingEmbeddingFunction(EmbeddingFunction[Documents]):
+    # Stand-in for the embedding model in benchmarks and offline runs: token counts hashed into
+    # `dim` signed buckets. Needs no model download and is fast, but only matches shared words
+    def __init__(self, dim: int = HASHING_DIM):
+        self.dim = dim
+
+    def __call__(self, input: Documents) -> Embeddings:
+        vectors = np.zeros((len(input), self.dim), dtype=np.float32)
+        for row, text in enumerate(input):
+            for token in re.findall(r"\w+", text.lower()):
+                # crc32 rather than hash() so that vectors are the same in every process
+                token_hash = zlib.crc32(token.encode("utf-8"))
+                vectors[row, token_hash % self.dim] += 1.0 if token_hash & 0x80000000 else -1.0
+        return vectors.tolist()
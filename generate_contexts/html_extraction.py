@@ -0,0 +1,204 @@
+from bs4 import BeautifulSoup
+from collections import defaultdict
+from html.parser import HTMLParser
+from typing import Optional
+
+# "bs4" is BeautifulSoup's get_text over the whole page, "text" a streaming parse of the visible
+# text without building a tree, and "main-content" the streaming parse without boilerplate
+# (navigation, headers and footers, menus, cookie banners and other link lists)
+EXTRACTION_ENGINE="bs4"
+EXTRACTION_ENGINES=["bs4", "text", "main-content"]
+# Tables, lists and other blocks outside <main> and <article> with at least this share of their
+# text inside links are dropped as menus and link lists
+MAX_LINK_DENSITY=0.5
+
+SKIP_TAGS={"script", "style", "noscript", "template", "svg", "iframe", "head", "title", "select", "button", "canvas", "object"}
+VOID_TAGS={"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"}
+BLOCK_TAGS={
+    "address", "article", "aside", "blockquote", "body", "caption", "dd", "details", "dialog", "div", "dl", "dt",
+    "figcaption", "figure", "footer", "form", "h1", "h2", "h3", "h4", "h5", "h6", "header", "hr", "li", "main",
+    "nav", "ol", "p", "pre", "section", "summary", "table", "tbody", "td", "tfoot", "th", "thead", "tr", "ul"
+}
+LINK_CONTAINER_TAGS={"table", "ul", "ol", "dl", "menu"}
+BOILERPLATE_TAGS={"nav", "footer", "aside", "form", "dialog"}
+BOILERPLATE_ROLES={"navigation", "banner", "contentinfo", "complementary", "dialog", "alertdialog", "search"}
+# Class and id values are matched whole or by these prefixes and suffixes, never by any token, so
+# that layout wrappers such as "has-sidebar" or "content-area" are kept
+BOILERPLATE_NAMES={
+    "nav", "navbar", "navigation", "menu", "topbar", "masthead", "footer", "sidebar", "breadcrumb", "breadcrumbs",
+    "cookie", "cookies", "consent", "gdpr", "banner", "popup", "modal", "newsletter", "subscribe", "share", "social",
+    "advert", "ads", "ad", "promo", "comments", "skip-link"
+}
+BOILERPLATE_PREFIXES=("cookie-", "cookies-", "consent-", "gdpr-", "nav-", "navbar-", "menu-", "footer-", "breadcrumb", "share-", "social-", "newsletter-", "advert", "ad-", "popup-", "modal-")
+BOILERPLATE_SUFFIXES=("-nav", "-navbar", "-navigation", "-menu", "-footer", "-breadcrumbs", "-cookies", "-share", "-social", "-popup")
+# Modifier classes describe the layout around the content, e.g. "has-sidebar"
+MODIFIER_PREFIXES=("has-", "is-", "with-", "no-")
+# Class and id values are not matched on these elements, which hold the content itself, nor on their ancestors
+CONTENT_TAGS={"html", "body", "main", "article"}
+
+def is_boilerplate_tag(tag: str, attrs: dict) -> bool:
+    if tag in BOILERPLATE_TAGS or "hidden" in attrs or attrs.get("aria-hidden") == "true":
+        return True
+    return (attrs.get("role") or "").lower() in BOILERPLATE_ROLES
+
+def is_boilerplate_name(attrs: dict) -> bool:
+    names = f"{attrs.get('class') or ''} {attrs.get('id') or ''}".lower().split()
+    return any(
+        name in BOILERPLATE_NAMES
+        or (not name.startswith(MODIFIER_PREFIXES) and (name.startswith(BOILERPLATE_PREFIXES) or name.endswith(BOILERPLATE_SUFFIXES)))
+        for name in names
+    )
+
+class TextExtractor(HTMLParser):
+    # Streams through the HTML once, keeping the open elements on a stack, and collects the text
+    # of each block element in parts. Unclosed elements are closed with their parent, as browsers
+    # do for e.g. <p> and <li>. Whether an element matched by its class or id is boilerplate is
+    # only known at the end, as it is kept when it turns out to contain <main> or <article>
+    def __init__(self, main_content: bool):
+        super().__init__(convert_charrefs=True)
+        self.main_content = main_content
+        self.stack = []
+        self.skip_depth = 0
+        self.boilerplate_depth = 0
+        self.link_depth = 0
+        self.content_depth = 0
+        self.open_names = []
+        self.kept_names = set()
+        self.next_name = 0
+        self.open_containers = []
+        self.next_container = 0
+        # Blocks as (parts, innermost open link container, inside main or article), and parts as
+        # (text, ids of open elements matched by name, inside a boilerplate tag, inside a link)
+        self.blocks = []
+        self.parts = []
+
+    def flush_block(self):
+        if self.parts:
+            self.blocks.append((self.parts, self.open_containers[-1] if self.open_containers else None, self.content_depth > 0))
+        self.parts = []
+
+    def handle_starttag(self, tag: str, attrs: list):
+        if tag in BLOCK_TAGS:
+            self.flush_block()
+        if tag in VOID_TAGS:
+            return
+
+        attrs = dict(attrs)
+        skip = tag in SKIP_TAGS
+        boilerplate = self.main_content and is_boilerplate_tag(tag, attrs)
+        name = None
+        if self.main_content and tag in CONTENT_TAGS:
+            self.kept_names.update(self.open_names)
+        elif self.main_content and is_boilerplate_name(attrs):
+            name = self.next_name
+            self.next_name += 1
+            self.open_names.append(name)
+        container = tag in LINK_CONTAINER_TAGS
+        if container:
+            self.open_containers.append(self.next_container)
+            self.next_container += 1
+        content = tag in ("main", "article")
+        link = tag == "a"
+        self.stack.append((tag, skip, boilerplate, link, name, container, content))
+        self.skip_depth += skip
+        self.boilerplate_depth += boilerplate
+        self.link_depth += link
+        self.content_depth += content
+
+    def handle_startendtag(self, tag: str, attrs: list):
+        if tag in BLOCK_TAGS:
+            self.flush_block()
+
+    def handle_endtag(self, tag: str):
+        if not any(entry[0] == tag for entry in self.stack):
+            return
+
+        while self.stack:
+            open_tag, skip, boilerplate, link, name, container, content = self.stack.pop()
+            if open_tag in BLOCK_TAGS:
+                self.flush_block()
+            self.skip_depth -= skip
+            self.boilerplate_depth -= boilerplate
+            self.link_depth -= link
+            self.content_depth -= content
+            if name is not None:
+                self.open_names.pop()
+            if container:
+                self.open_containers.pop()
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data: str):
+        if self.skip_depth:
+            return
+        text = " ".join(data.split())
+        if text:
+            self.parts.append((text, tuple(self.open_names), self.boilerplate_depth > 0, self.link_depth > 0))
+
+    def text(self) -> str:
+        self.flush_block()
+        all_text = " ".join(text for parts, _, _ in self.blocks for text, _, _, _ in parts)
+        if not self.main_content:
+            return all_text
+
+        # Link density is measured over a whole table or list as the share of its cells or items
+        # that are mostly a link, as in menus, so that e.g. the linked team names of a standings
+        # table are kept. Other blocks are measured by themselves as the share of linked text
+        blocks = []
+        lengths, link_lengths = defaultdict(int), defaultdict(int)
+        kept_lengths, kept_link_lengths = defaultdict(int), defaultdict(int)
+        for index, (parts, container, in_content) in enumerate(self.blocks):
+            kept = [
+                (text, link) for text, names, boilerplate, link in parts
+                if not boilerplate and all(name in self.kept_names for name in names)
+            ]
+            length = sum(len(text) for text, _, _, _ in parts)
+            link_length = sum(len(text) for text, _, _, link in parts if link)
+            kept_length = sum(len(text) for text, _ in kept)
+            kept_link_length = sum(len(text) for text, link in kept if link)
+            if container is not None:
+                key = ("container", container)
+                length, link_length = 1, int(link_length * 2 > length)
+                kept_length, kept_link_length = int(kept_length > 0), int(kept_link_length * 2 > kept_length)
+            else:
+                key = ("block", index)
+            blocks.append((key, parts, kept, in_content))
+            lengths[key] += length
+            link_lengths[key] += link_length
+            kept_lengths[key] += kept_length
+            kept_link_lengths[key] += kept_link_length
+
+        main_blocks = []
+        largest_block, largest_block_kept = 0, True
+        for key, parts, kept, in_content in blocks:
+            # Within main or article, links are taken to be part of the content
+            kept_length = sum(len(text) for text, _ in kept)
+            is_kept = kept_length > 0 and (in_content or kept_link_lengths[key] / kept_lengths[key] < MAX_LINK_DENSITY)
+            if is_kept:
+                main_blocks.append(" ".join(text for text, _ in kept))
+
+            # The largest block that is not part of a link list is taken to be content
+            block_length = sum(len(text) for text, _, _, _ in parts)
+            if block_length > largest_block and link_lengths[key] / lengths[key] < MAX_LINK_DENSITY:
+                largest_block, largest_block_kept = block_length, is_kept and kept_length * 2 >= block_length
+
+        # Markup that hides the content as boilerplate falls back to the whole text
+        return " ".join(main_blocks) if largest_block_kept else all_text
+
+def extract_with_bs4(page_result: str) -> str:
+    soup = BeautifulSoup(page_result, 'html.parser')
+    return soup.get_text(separator=' ', strip=True)
+
+def extract_with_parser(page_result: str, main_content: bool) -> str:
+    extractor = TextExtractor(main_content)
+    extractor.feed(page_result)
+    extractor.close()
+    return extractor.text()
+
+def extract_page_text(page_result: str, engine: Optional[str] = None) -> str:
+    engine = engine or EXTRACTION_ENGINE
+    if engine == "bs4":
+        return extract_with_bs4(page_result)
+    if engine in ("text", "main-content"):
+        return extract_with_parser(page_result, main_content=engine == "main-content")
+    raise ValueError(f"Unknown extraction engine {engine}, choose from {EXTRACTION_ENGINES}")
@@ -0,0 +1,54 @@
+from crag_index import read_items
+from retriever import CASCADE_RETRIEVAL, VECTOR_STORE, collection_name, list_collection_names, get_collection
+import numpy as np
+import sys
+import time
+
+SEARCH_DIMS=[64, 128, 256, 512]
+
+def matryoshka_report(search_dims=SEARCH_DIMS, num_items: int = 300, k: int = 6):
+    # For each reduced dimension: bytes per stored search vector, search latency per query and
+    # recall@k against exact search with the full vectors, over the saved numpy stores
+    if VECTOR_STORE != "numpy" or CASCADE_RETRIEVAL:
+        raise ValueError("The report compares saved numpy stores, set VECTOR_STORE=\"numpy\" without CASCADE_RETRIEVAL and generate contexts first")
+
+    with open("random_nums.txt", "r") as f:
+        line_numbers = set(map(int, f.readlines()[:num_items]))
+
+    existing_collections = list_collection_names()
+    line_numbers = {line_number for line_number in line_numbers if collection_name(line_number) in existing_collections}
+
+    recalls = {dim: [] for dim in [None] + search_dims}
+    seconds = {dim: 0.0 for dim in [None] + search_dims}
+    bytes_per_vector = {}
+
+    for line_number, item in read_items(line_numbers):
+        store = get_collection(line_number)
+        if len(store.ids) == 0:
+            continue
+        query_vectors = store.embed_queries([item['query']])
+
+        for dim in [None] + search_dims:
+            store.set_search_dim(dim)
+            start = time.perf_counter()
+            results = store.search(query_vectors, k)[0]
+            seconds[dim] += time.perf_counter() - start
+
+            retrieved = {result["id"] for result in results}
+            if dim is None:
+                expected = retrieved
+                bytes_per_vector[dim] = store.vectors.shape[1] * store.vectors.dtype.itemsize
+            else:
+                bytes_per_vector[dim] = store.search_vectors.shape[1] * store.search_vectors.dtype.itemsize
+            recalls[dim].append(len(expected & retrieved) / len(expected))
+
+    for dim in [None] + search_dims:
+        if not recalls[dim]:
+            continue
+        print(
+            f"{'full' if dim is None else dim:>5} dimensions: {bytes_per_vector[dim]} bytes per vector, "
+            f"{seconds[dim] / len(recalls[dim]) * 1000:.3f} ms per query, recall@{k} {np.mean(recalls[dim]):.4f}"
+        )
+
+if __name__ == "__main__":
+    matryoshka_report([int(dim) for dim in sys.argv[1:]] or SEARCH_DIMS)
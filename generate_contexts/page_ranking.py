@@ -0,0 +1,68 @@
+from collections import Counter
+from typing import Dict, List
+import math
+import numpy as np
+import re
+
+def tokenize(text: str) -> List[str]:
+    return re.findall(r"\w+", text.lower())
+
+def page_summary(result: Dict) -> str:
+    return f"{result.get('page_name') or ''} {result.get('page_snippet') or ''}"
+
+class BM25Index:
+    # Term statistics of the documents are computed once and shared by all queries. Documents
+    # can be added in batches, each is only tokenized when it is added
+    def __init__(self, documents: List[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_frequencies: List[Counter] = []
+        self.lengths: List[int] = []
+        self.average_length = 1
+        self.document_frequencies = Counter()
+        self.add(documents)
+
+    def add(self, documents: List[str]):
+        term_frequencies = [Counter(tokenize(document)) for document in documents]
+        self.term_frequencies.extend(term_frequencies)
+        self.lengths.extend(sum(document_terms.values()) for document_terms in term_frequencies)
+        self.average_length = sum(self.lengths) / max(len(self.lengths), 1) or 1
+        for document_terms in term_frequencies:
+            self.document_frequencies.update(document_terms.keys())
+
+    def scores(self, query: str) -> List[float]:
+        num_documents = len(self.term_frequencies)
+        idfs = {
+            token: math.log(1 + (num_documents - self.document_frequencies[token] + 0.5) / (self.document_frequencies[token] + 0.5))
+            for token in set(tokenize(query)) if token in self.document_frequencies
+        }
+
+        scores = []
+        for term_frequencies, length in zip(self.term_frequencies, self.lengths):
+            score = 0.0
+            for token, idf in idfs.items():
+                tf = term_frequencies.get(token)
+                if tf:
+                    score += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / self.average_length))
+            scores.append(score)
+        return scores
+
+def bm25_scores(query: str, documents: List[str], k1: float = 1.5, b: float = 0.75) -> List[float]:
+    return BM25Index(documents, k1, b).scores(query)
+
+def embedding_scores(query: str, documents: List[str], embedding_function) -> List[float]:
+    vectors = np.asarray(embedding_function([query] + documents), dtype=np.float32)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    return (vectors[1:] @ vectors[0]).tolist()
+
+def rank_pages(query: str, search_results: List[Dict], method: str = "lexical", embedding_function=None) -> List[int]:
+    # Indices of search_results ordered by how well their name and snippet match the query;
+    # ties keep the search engine order
+    documents = [page_summary(result) for result in search_results]
+
+    if method == "embedding":
+        scores = embedding_scores(query, documents, embedding_function)
+    else:
+        scores = bm25_scores(query, documents)
+
+    return sorted(range(len(documents)), key=lambda i: -scores[i])
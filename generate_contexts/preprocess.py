@@ -0,0 +1,93 @@
+from llama_index.core.node_parser import SentenceSplitter
+from concurrent.futures import Future, ProcessPoolExecutor
+from collections import deque
+from functools import lru_cache
+import multiprocessing
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import os
+import time
+from html_extraction import EXTRACTION_ENGINE, extract_page_text
+from text_store import TEXT_STORE_PATH, get_text, put_text
+
+PREPROCESS_WORKERS=os.cpu_count()
+PREPROCESS_LOOKAHEAD=2
+# Reuse the plain text extracted from each page by earlier runs, see text_store.py
+USE_TEXT_STORE=True
+
+@lru_cache(maxsize=None)
+def get_sentence_splitter(chunk_size: int, chunk_overlap: int) -> SentenceSplitter:
+    return SentenceSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+def extract_text(page_result: str, engine: str = EXTRACTION_ENGINE) -> str:
+    # See html_extraction.py for the engines
+    return extract_page_text(page_result, engine)
+
+def page_text(page_result: str, page_key: Optional[Tuple[str, str]] = None, engine: str = EXTRACTION_ENGINE) -> str:
+    # page_key is (interaction_id, page_url); without it the HTML is always parsed
+    if not USE_TEXT_STORE or page_key is None:
+        return extract_text(page_result, engine)
+
+    text = get_text(*page_key, TEXT_STORE_PATH, engine)
+    if text is None:
+        text = extract_text(page_result, engine)
+        put_text(*page_key, text, TEXT_STORE_PATH, engine)
+    return text
+
+def split_page(
+    page_result: str, chunk_size: int, chunk_overlap: int, page_key: Optional[Tuple[str, str]] = None, engine: str = EXTRACTION_ENGINE
+) -> List[str]:
+    return get_sentence_splitter(chunk_size, chunk_overlap).split_text(page_text(page_result, page_key, engine))
+
+def split_page_timed(
+    page_result: str, chunk_size: int, chunk_overlap: int, page_key: Optional[Tuple[str, str]] = None
+) -> Tuple[List[str], Dict[str, Dict[str, float]]]:
+    # Spans cannot be recorded in worker processes, so the durations are returned with the chunks,
+    # together with the bytes of HTML in, characters of text out and chunks produced for the page
+    start = time.perf_counter()
+    text = page_text(page_result, page_key)
+    extracted = time.perf_counter()
+    chunks = get_sentence_splitter(chunk_size, chunk_overlap).split_text(text)
+    return chunks, {
+        "html_parse": {"seconds": extracted - start, "html_bytes": len(page_result.encode("utf-8")), "text_chars": len(text)},
+        "chunking": {"seconds": time.perf_counter() - extracted, "chunks": len(chunks)}
+    }
+
+def page_key(item: Dict, page_index: int) -> Tuple[str, str]:
+    return str(item['interaction_id']), str(item['search_results'][page_index]['page_url'])
+
+def preprocess_items(
+    items: Iterable[Tuple[int, Dict]],
+    chunk_size: int,
+    chunk_overlap: int,
+    select_pages: Callable[[int, Dict], Optional[List[int]]],
+    num_workers: Optional[int] = PREPROCESS_WORKERS,
+    lookahead: int = PREPROCESS_LOOKAHEAD
+) -> Iterator[Tuple[int, Dict, Optional[List[Tuple[int, Future]]]]]:
+    # Pages of the next `lookahead` items are parsed and chunked in worker processes
+    # while the caller is still embedding the current item. select_pages returns the
+    # indices of the pages to parse for an item, or None when nothing has to be parsed.
+    # Workers are spawned rather than forked so that they never inherit an initialized CUDA context
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending = deque()
+
+        for line_number, item in items:
+            page_indices = select_pages(line_number, item)
+            page_chunks = None
+            if page_indices is not None:
+                page_chunks = [
+                    (page_index, executor.submit(
+                        split_page_timed,
+                        item['search_results'][page_index]['page_result'],
+                        chunk_size,
+                        chunk_overlap,
+                        page_key(item, page_index)
+                    ))
+                    for page_index in page_indices
+                ]
+
+            pending.append((line_number, item, page_chunks))
+            if len(pending) > lookahead:
+                yield pending.popleft()
+
+        while pending:
+            yield pending.popleft()
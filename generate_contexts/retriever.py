@@ -0,0 +1,222 @@
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+from functools import lru_cache
+from typing import Dict, List, Set, Union
+import chromadb
+import chromadb.utils.embedding_functions
+import hashlib
+import json
+import os
+import sys
+import torch
+
+# common/ is imported from the repository root, also when the scripts of this directory run on their own
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.tracing import span
+from cpu_embedding import CPUEmbeddingFunction
+from embedding_cache import CachedEmbeddingFunction
+from hashing_embedding import HashingEmbeddingFunction
+from html_extraction import EXTRACTION_ENGINE
+from vector_store import BM25Store, CascadeStore, ChromaStore, NumpyStore
+
+BASE_DIR=os.path.dirname(os.path.abspath(__file__))
+EMBED_MODEL=os.path.join(BASE_DIR, "model/dunzhang/stella_en_1.5B_v5")
+CHROMA_PATH=os.path.join(BASE_DIR, "chromadb")
+NUMPY_STORE_PATH=os.path.join(BASE_DIR, "numpy_store")
+CHUNK_SIZE=3072
+CHUNK_OVERLAP=int(0.2 * CHUNK_SIZE)
+DISTANCE_METRIC="cosine"
+# "chroma" for per-item Chroma HNSW collections, "numpy" for exact search over a saved embedding matrix
+VECTOR_STORE="chroma"
+NUMPY_STORE_DTYPE="float32"
+# With VECTOR_STORE="numpy", search candidates among the first MATRYOSHKA_DIM dimensions stored as float16
+# and re-score the best MATRYOSHKA_RERANK_FACTOR * top k with the full vectors (see matryoshka_report.py)
+MATRYOSHKA_DIM=None
+MATRYOSHKA_RERANK_FACTOR=10
+# Index only the pages whose names and snippets match the query best ("lexical" or "embedding" ranking):
+# the best LAZY_INITIAL_PAGES are indexed, and LAZY_EXPAND_PAGES more are indexed while the best
+# retrieval score for the query stays below LAZY_SCORE_THRESHOLD
+LAZY_INDEXING=False
+LAZY_PAGE_SCORER="lexical"
+LAZY_INITIAL_PAGES=10
+LAZY_EXPAND_PAGES=10
+LAZY_SCORE_THRESHOLD=0.5
+# "sentence-transformers" embeds on the GPU when available, "cpu" with length-bucketed batches,
+# "cpu-int8" additionally with int8 dynamic quantization (check recall with embedding_parity.py),
+# "hashing" replaces the model by hashed word counts for benchmarks without the model
+EMBEDDING_BACKEND="sentence-transformers"
+CPU_EMBEDDING_THREADS=None
+USE_EMBEDDING_CACHE=True
+EMBEDDING_CACHE_PATH=os.path.join(BASE_DIR, "embedding_cache")
+# Cascade retrieval indexes all chunks with a cheap first tier, "bm25" or "embedding" with the
+# small model at CASCADE_FIRST_TIER_MODEL (stored as set by VECTOR_STORE), and embeds only the best
+# CASCADE_CANDIDATES chunks per query with EMBED_MODEL to re-rank them (see cascade_report.py).
+# Applies to generate_contexts.py and RIG alike, as both use the same collections
+CASCADE_RETRIEVAL=False
+CASCADE_FIRST_TIER="bm25"
+CASCADE_FIRST_TIER_MODEL=os.path.join(BASE_DIR, "model/BAAI/bge-small-en-v1.5")
+CASCADE_CANDIDATES=30
+
+VectorStore = Union[ChromaStore, NumpyStore, BM25Store, CascadeStore]
+
+_collections: Dict[str, VectorStore] = {}
+
+class TracedEmbeddingFunction(EmbeddingFunction[Documents]):
+    # Model calls are traced as "embed" spans, nested in the span of the index insert or query
+    # that needs them. Texts found in the embedding cache never reach the model
+    def __init__(self, embedding_function: EmbeddingFunction):
+        self.embedding_function = embedding_function
+
+    def __call__(self, input: Documents) -> Embeddings:
+        with span("embed", texts=len(input)):
+            return self.embedding_function(input)
+
+@lru_cache(maxsize=None)
+def get_db(path: str = CHROMA_PATH) -> chromadb.ClientAPI:
+    return chromadb.PersistentClient(path=path)
+
+def embedding_model_key(embed_model: str, backend: str = EMBEDDING_BACKEND) -> str:
+    # Quantized embeddings differ from the full-precision ones and are cached and indexed separately
+    if backend == "hashing":
+        return "hashing"
+
+    model_key = os.path.basename(os.path.normpath(embed_model))
+    return f"{model_key}-int8" if backend == "cpu-int8" else model_key
+
+@lru_cache(maxsize=None)
+def get_embedding_function(embed_model: str = EMBED_MODEL, backend: str = EMBEDDING_BACKEND):
+    if backend == "hashing":
+        embedding_function = HashingEmbeddingFunction()
+    elif backend in ("cpu", "cpu-int8"):
+        embedding_function = CPUEmbeddingFunction(embed_model, quantize=backend == "cpu-int8", num_threads=CPU_EMBEDDING_THREADS)
+    else:
+        embedding_function = chromadb.utils.embedding_functions.SentenceTransformerEmbeddingFunction(
+            model_name=embed_model,
+            device=torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        )
+    embedding_function = TracedEmbeddingFunction(embedding_function)
+
+    if USE_EMBEDDING_CACHE:
+        return CachedEmbeddingFunction(embedding_function, embedding_model_key(embed_model, backend), EMBEDDING_CACHE_PATH)
+
+    return embedding_function
+
+def index_params(embed_model: str, chunk_size: int, chunk_overlap: int, distance_metric: str) -> Dict:
+    return {
+        "embed_model": embedding_model_key(embed_model),
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "extraction_engine": EXTRACTION_ENGINE,
+        "distance_metric": distance_metric,
+        "vector_store": VECTOR_STORE,
+        "numpy_store_dtype": NUMPY_STORE_DTYPE if VECTOR_STORE == "numpy" else None,
+        "matryoshka_dim": MATRYOSHKA_DIM,
+        "lazy_indexing": [LAZY_PAGE_SCORER, LAZY_INITIAL_PAGES, LAZY_EXPAND_PAGES, LAZY_SCORE_THRESHOLD] if LAZY_INDEXING else None,
+        "cascade_first_tier": cascade_first_tier_key() if CASCADE_RETRIEVAL else None
+    }
+
+def cascade_first_tier_key() -> str:
+    # Embeddings of the two tiers are cached separately under their own model keys
+    return "bm25" if CASCADE_FIRST_TIER == "bm25" else embedding_model_key(CASCADE_FIRST_TIER_MODEL)
+
+def collection_name(
+    item_id: int,
+    embed_model: str = EMBED_MODEL,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    distance_metric: str = DISTANCE_METRIC
+) -> str:
+    # Collections built with different chunking or embedding parameters exist side by side
+    params = index_params(embed_model, chunk_size, chunk_overlap, distance_metric)
+    params_hash = hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:12]
+    return f"collection_{item_id}_{params_hash}"
+
+def uses_file_stores() -> bool:
+    return VECTOR_STORE == "numpy" or (CASCADE_RETRIEVAL and CASCADE_FIRST_TIER == "bm25")
+
+def list_collection_names() -> Set[str]:
+    if uses_file_stores():
+        if not os.path.exists(NUMPY_STORE_PATH):
+            return set()
+        return {name for name in os.listdir(NUMPY_STORE_PATH) if NumpyStore.exists(os.path.join(NUMPY_STORE_PATH, name))}
+
+    return {collection.name for collection in get_db().list_collections() if (collection.metadata or {}).get("complete")}
+
+def cascade_store(first_tier: VectorStore, embed_model: str, distance_metric: str) -> VectorStore:
+    if not CASCADE_RETRIEVAL:
+        return first_tier
+    return CascadeStore(first_tier, get_embedding_function(embed_model), distance_metric, CASCADE_CANDIDATES)
+
+def get_collection(
+    item_id: int,
+    embed_model: str = EMBED_MODEL,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    distance_metric: str = DISTANCE_METRIC
+) -> VectorStore:
+    name = collection_name(item_id, embed_model, chunk_size, chunk_overlap, distance_metric)
+
+    if name not in _collections:
+        index_model = CASCADE_FIRST_TIER_MODEL if CASCADE_RETRIEVAL else embed_model
+        if CASCADE_RETRIEVAL and CASCADE_FIRST_TIER == "bm25":
+            store = BM25Store.load(os.path.join(NUMPY_STORE_PATH, name))
+        elif VECTOR_STORE == "numpy":
+            store = NumpyStore.load(
+                os.path.join(NUMPY_STORE_PATH, name), get_embedding_function(index_model), MATRYOSHKA_RERANK_FACTOR
+            )
+        else:
+            store = ChromaStore(get_db().get_collection(
+                name=name,
+                embedding_function=get_embedding_function(index_model)
+            ))
+        _collections[name] = cascade_store(store, embed_model, distance_metric)
+
+    return _collections[name]
+
+def create_collection(
+    item_id: int,
+    embed_model: str = EMBED_MODEL,
+    chunk_size: int = CHUNK_SIZE,
+    chunk_overlap: int = CHUNK_OVERLAP,
+    distance_metric: str = DISTANCE_METRIC
+) -> VectorStore:
+    name = collection_name(item_id, embed_model, chunk_size, chunk_overlap, distance_metric)
+    # With cascade retrieval, the stores below hold the first tier
+    index_model = CASCADE_FIRST_TIER_MODEL if CASCADE_RETRIEVAL else embed_model
+
+    if CASCADE_RETRIEVAL and CASCADE_FIRST_TIER == "bm25":
+        _collections[name] = cascade_store(BM25Store(os.path.join(NUMPY_STORE_PATH, name)), embed_model, distance_metric)
+        return _collections[name]
+
+    if VECTOR_STORE == "numpy":
+        _collections[name] = cascade_store(NumpyStore(
+            os.path.join(NUMPY_STORE_PATH, name),
+            get_embedding_function(index_model),
+            distance_metric,
+            NUMPY_STORE_DTYPE,
+            MATRYOSHKA_DIM,
+            MATRYOSHKA_RERANK_FACTOR
+        ), embed_model, distance_metric)
+        return _collections[name]
+
+    if MATRYOSHKA_DIM:
+        raise ValueError("MATRYOSHKA_DIM requires VECTOR_STORE=\"numpy\"")
+
+    collection_params = {
+        "name": name,
+        "embedding_function": get_embedding_function(index_model)
+    }
+
+    if distance_metric != "l2":
+        collection_params["metadata"] = {"hnsw:space": distance_metric}
+
+    # A collection left incomplete by an interrupted run is rebuilt
+    try:
+        get_db().delete_collection(name)
+    except ValueError:
+        pass
+
+    _collections[name] = cascade_store(ChromaStore(get_db().create_collection(**collection_params)), embed_model, distance_metric)
+    return _collections[name]
+
+def query_collection(collection: VectorStore, query_texts: List[str], n_results: int) -> List[List[Dict]]:
+    return collection.query(query_texts, n_results)
@@ -0,0 +1,41 @@
+from functools import lru_cache
+from typing import Optional
+import os
+import re
+import sqlite3
+import zlib
+
+TEXT_STORE_PATH=os.path.join(os.path.dirname(os.path.abspath(__file__)), "text_store.sqlite")
+# Text of the default extraction engine is kept in page_text, that of other engines in tables of their own
+DEFAULT_ENGINE="bs4"
+
+@lru_cache(maxsize=None)
+def get_connection(path: str = TEXT_STORE_PATH) -> sqlite3.Connection:
+    # One connection per process; preprocessing workers read and write the store concurrently
+    connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    return connection
+
+@lru_cache(maxsize=None)
+def get_table(engine: str = DEFAULT_ENGINE, path: str = TEXT_STORE_PATH) -> str:
+    table = "page_text" if engine == DEFAULT_ENGINE else "page_text_" + re.sub(r"[^A-Za-z0-9]+", "_", engine)
+    get_connection(path).execute(
+        f"CREATE TABLE IF NOT EXISTS {table} ("
+        "interaction_id TEXT NOT NULL, page_url TEXT NOT NULL, text BLOB NOT NULL, "
+        "PRIMARY KEY (interaction_id, page_url))"
+    )
+    return table
+
+def get_text(interaction_id: str, page_url: str, path: str = TEXT_STORE_PATH, engine: str = DEFAULT_ENGINE) -> Optional[str]:
+    row = get_connection(path).execute(
+        f"SELECT text FROM {get_table(engine, path)} WHERE interaction_id = ? AND page_url = ?",
+        (interaction_id, page_url)
+    ).fetchone()
+    return zlib.decompress(row[0]).decode("utf-8") if row else None
+
+def put_text(interaction_id: str, page_url: str, text: str, path: str = TEXT_STORE_PATH, engine: str = DEFAULT_ENGINE):
+    get_connection(path).execute(
+        f"INSERT OR REPLACE INTO {get_table(engine, path)} (interaction_id, page_url, text) VALUES (?, ?, ?)",
+        (interaction_id, page_url, zlib.compress(text.encode("utf-8")))
+    )
@@ -0,0 +1,278 @@
+from typing import Dict, List, Optional
+import chromadb
+import json
+import numpy as np
+import os
+from page_ranking import BM25Index
+
+class ChromaStore:
+    # Per-item Chroma collection with an HNSW index
+    def __init__(self, collection: chromadb.Collection):
+        self.collection = collection
+
+    def add(self, documents: List[str], metadatas: List[Dict], ids: List[str]):
+        self.collection.add(documents=documents, metadatas=metadatas, ids=ids)
+
+    def persist(self):
+        # Chunks are added in batches, so a collection of an interrupted run can be half filled and
+        # only collections marked complete are reused. Chroma refuses hnsw: keys in modify, the
+        # distance metric stays with the index
+        metadata = {key: value for key, value in (self.collection.metadata or {}).items() if not key.startswith("hnsw:")}
+        self.collection.modify(metadata={**metadata, "complete": True})
+
+    def query(self, query_texts: List[str], n_results: int) -> List[List[Dict]]:
+        # All query texts are embedded in one batch and searched in one call
+        query_results = self.collection.query(
+            query_texts=query_texts,
+            n_results=n_results,
+            include=["documents", "distances"]
+        )
+
+        return [
+            [
+                {"id": chunk_id, "document": document, "score": 1 - distance}  # Convert distance to similarity score
+                for chunk_id, document, distance in zip(ids, documents, distances)
+            ]
+            for ids, documents, distances in zip(query_results['ids'], query_results['documents'], query_results['distances'])
+        ]
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+class NumpyStore:
+    # Exact search over a contiguous embedding matrix, one matmul per batch of queries.
+    # Saved as vectors.npy and chunks.jsonl in its own directory and memory-mapped when loaded.
+    # With search_dim, candidates are searched among the first search_dim dimensions (Matryoshka
+    # embeddings) stored separately as float16, and only the best rerank_factor * n_results
+    # candidates are scored with the full vectors
+    def __init__(
+        self,
+        path: str,
+        embedding_function,
+        distance_metric: str = "cosine",
+        dtype: str = "float32",
+        search_dim: Optional[int] = None,
+        rerank_factor: int = 10
+    ):
+        self.path = path
+        self.embedding_function = embedding_function
+        self.distance_metric = distance_metric
+        self.dtype = dtype
+        self.search_dim = search_dim
+        self.rerank_factor = rerank_factor
+        self.vectors = np.zeros((0, 0), dtype=dtype)
+        self.search_vectors = np.zeros((0, 0), dtype=np.float16)
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.metadatas: List[Dict] = []
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, "chunks.jsonl"))
+
+    @classmethod
+    def load(cls, path: str, embedding_function, rerank_factor: int = 10) -> "NumpyStore":
+        with open(os.path.join(path, "meta.json"), "r") as meta_file:
+            meta = json.load(meta_file)
+
+        store = cls(path, embedding_function, meta["distance_metric"], meta["dtype"], meta.get("search_dim"), rerank_factor)
+        store.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        if store.search_dim:
+            store.search_vectors = np.load(os.path.join(path, "search_vectors.npy"), mmap_mode="r")
+
+        with open(os.path.join(path, "chunks.jsonl"), "r") as chunks_file:
+            for line in chunks_file:
+                chunk = json.loads(line)
+                store.ids.append(chunk["id"])
+                store.documents.append(chunk["document"])
+                store.metadatas.append(chunk["metadata"])
+
+        return store
+
+    def _prepare(self, vectors) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.distance_metric == "cosine":
+            vectors = normalize(vectors)
+        return vectors
+
+    def embed_queries(self, query_texts: List[str]) -> np.ndarray:
+        # Query vectors ready for search, e.g. to search the same queries several times
+        return self._prepare(self.embedding_function(query_texts))
+
+    def truncate(self, vectors: np.ndarray) -> np.ndarray:
+        return normalize(np.asarray(vectors[:, :self.search_dim], dtype=np.float32)).astype(np.float16)
+
+    def set_search_dim(self, search_dim: Optional[int]):
+        # Rebuilds the reduced vectors from the full ones, e.g. to compare dimensions on a saved store
+        self.search_dim = search_dim
+        self.search_vectors = self.truncate(self.vectors) if search_dim else np.zeros((0, 0), dtype=np.float16)
+
+    def add(self, documents: List[str], metadatas: List[Dict], ids: List[str]):
+        self.add_vectors(self.embedding_function(documents), documents, metadatas, ids)
+
+    def add_vectors(self, vectors, documents: List[str], metadatas: List[Dict], ids: List[str]):
+        # For chunks embedded elsewhere, e.g. batched with other requests
+        vectors = self._prepare(vectors)
+        if self.search_dim:
+            search_vectors = self.truncate(vectors)
+            self.search_vectors = search_vectors if len(self.ids) == 0 else np.concatenate([self.search_vectors, search_vectors])
+
+        vectors = vectors.astype(self.dtype)
+        self.vectors = vectors if len(self.ids) == 0 else np.concatenate([self.vectors, vectors])
+        self.ids.extend(ids)
+        self.documents.extend(documents)
+        self.metadatas.extend(metadatas)
+
+    def persist(self):
+        # chunks.jsonl is written last and marks the store as complete
+        os.makedirs(self.path, exist_ok=True)
+        np.save(os.path.join(self.path, "vectors.npy"), np.ascontiguousarray(self.vectors))
+        if self.search_dim:
+            np.save(os.path.join(self.path, "search_vectors.npy"), np.ascontiguousarray(self.search_vectors))
+        with open(os.path.join(self.path, "meta.json"), "w") as meta_file:
+            json.dump({"distance_metric": self.distance_metric, "dtype": self.dtype, "search_dim": self.search_dim}, meta_file)
+        with open(os.path.join(self.path, "chunks.jsonl.tmp"), "w") as chunks_file:
+            for chunk_id, document, metadata in zip(self.ids, self.documents, self.metadatas):
+                chunks_file.write(json.dumps({"id": chunk_id, "document": document, "metadata": metadata}) + "\n")
+        os.replace(os.path.join(self.path, "chunks.jsonl.tmp"), os.path.join(self.path, "chunks.jsonl"))
+
+    def scores(self, query_vectors: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        vectors = np.asarray(self.vectors if rows is None else self.vectors[rows], dtype=np.float32)
+        similarities = query_vectors @ vectors.T
+
+        # Same scale as 1 - distance of the Chroma store
+        if self.distance_metric == "l2":
+            squared_norms = np.sum(vectors ** 2, axis=1)
+            return 1 - (np.sum(query_vectors ** 2, axis=1, keepdims=True) + squared_norms - 2 * similarities)
+        return similarities
+
+    def candidates(self, query_vectors: np.ndarray, n_candidates: int) -> np.ndarray:
+        # Rows most similar to each query on the reduced vectors, in row order
+        similarities = self.truncate(query_vectors).astype(np.float32) @ np.asarray(self.search_vectors, dtype=np.float32).T
+        if n_candidates >= len(self.ids):
+            return np.tile(np.arange(len(self.ids)), (len(query_vectors), 1))
+        return np.sort(np.argpartition(-similarities, n_candidates - 1, axis=1)[:, :n_candidates], axis=1)
+
+    def search(self, query_vectors, n_results: int) -> List[List[Dict]]:
+        if len(self.ids) == 0:
+            return [[] for _ in query_vectors]
+
+        query_vectors = self._prepare(query_vectors)
+        k = min(n_results, len(self.ids))
+
+        if self.search_dim:
+            candidate_rows = self.candidates(query_vectors, k * self.rerank_factor)
+            candidate_scores = [self.scores(query_vector[None], rows)[0] for query_vector, rows in zip(query_vectors, candidate_rows)]
+        else:
+            candidate_rows = [np.arange(len(self.ids))] * len(query_vectors)
+            candidate_scores = self.scores(query_vectors)
+
+        results = []
+        for rows, query_scores in zip(candidate_rows, candidate_scores):
+            top = np.argpartition(-query_scores, k - 1)[:k]
+            top = top[np.argsort(-query_scores[top])]
+            results.append([
+                {"id": self.ids[rows[i]], "document": self.documents[rows[i]], "score": float(query_scores[i])}
+                for i in top
+            ])
+        return results
+
+    def query(self, query_texts: List[str], n_results: int) -> List[List[Dict]]:
+        if len(self.ids) == 0:
+            return [[] for _ in query_texts]
+        return self.search(self.embedding_function(query_texts), n_results)
+
+class BM25Store:
+    # BM25 over the words of the chunks, saved as chunks.jsonl like NumpyStore. The term
+    # statistics are built as chunks are added or loaded, so indexing pays for them, not the first query
+    def __init__(self, path: str):
+        self.path = path
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.metadatas: List[Dict] = []
+        self.index = BM25Index([])
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, "chunks.jsonl"))
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Store":
+        store = cls(path)
+        with open(os.path.join(path, "chunks.jsonl"), "r") as chunks_file:
+            for line in chunks_file:
+                chunk = json.loads(line)
+                store.ids.append(chunk["id"])
+                store.documents.append(chunk["document"])
+                store.metadatas.append(chunk["metadata"])
+        store.index.add(store.documents)
+        return store
+
+    def add(self, documents: List[str], metadatas: List[Dict], ids: List[str]):
+        self.ids.extend(ids)
+        self.documents.extend(documents)
+        self.metadatas.extend(metadatas)
+        self.index.add(documents)
+
+    def persist(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "chunks.jsonl.tmp"), "w") as chunks_file:
+            for chunk_id, document, metadata in zip(self.ids, self.documents, self.metadatas):
+                chunks_file.write(json.dumps({"id": chunk_id, "document": document, "metadata": metadata}) + "\n")
+        os.replace(os.path.join(self.path, "chunks.jsonl.tmp"), os.path.join(self.path, "chunks.jsonl"))
+
+    def query(self, query_texts: List[str], n_results: int) -> List[List[Dict]]:
+        results = []
+        for query_text in query_texts:
+            scores = np.asarray(self.index.scores(query_text))
+            top = np.argsort(-scores, kind="stable")[:n_results]
+            results.append([{"id": self.ids[i], "document": self.documents[i], "score": float(scores[i])} for i in top])
+        return results
+
+class CascadeStore:
+    # Two-tier retrieval: the first tier (a BM25Store, or a store embedded with a small model)
+    # holds all chunks, and only its best `candidates` chunks per query are embedded with
+    # rerank_function and re-scored on the same scale as a single-tier store of that model
+    def __init__(self, first_tier, rerank_function, distance_metric: str = "cosine", candidates: int = 30):
+        self.first_tier = first_tier
+        self.rerank_function = rerank_function
+        self.distance_metric = distance_metric
+        self.candidates = candidates
+
+    def add(self, documents: List[str], metadatas: List[Dict], ids: List[str]):
+        self.first_tier.add(documents, metadatas, ids)
+
+    def persist(self):
+        self.first_tier.persist()
+
+    def query(self, query_texts: List[str], n_results: int) -> List[List[Dict]]:
+        candidates = self.first_tier.query(query_texts, max(self.candidates, n_results))
+
+        documents = {}
+        for query_candidates in candidates:
+            for result in query_candidates:
+                documents.setdefault(result["id"], result["document"])
+        if not documents:
+            return [[] for _ in query_texts]
+
+        # Queries and the candidates of all queries are embedded in one batch
+        ids = list(documents)
+        vectors = self.rerank_function(query_texts + [documents[chunk_id] for chunk_id in ids])
+        rerank_store = NumpyStore("", None, self.distance_metric)
+        rerank_store.add_vectors(vectors[len(query_texts):], [documents[chunk_id] for chunk_id in ids], [{}] * len(ids), ids)
+        query_vectors = rerank_store._prepare(vectors[:len(query_texts)])
+        rows = {chunk_id: row for row, chunk_id in enumerate(ids)}
+
+        results = []
+        for query_vector, query_candidates in zip(query_vectors, candidates):
+            candidate_rows = np.array([rows[result["id"]] for result in query_candidates], dtype=np.int64)
+            if len(candidate_rows) == 0:
+                results.append([])
+                continue
+
+            query_scores = rerank_store.scores(query_vector[None], candidate_rows)[0]
+            results.append([
+                {"id": ids[candidate_rows[i]], "document": documents[ids[candidate_rows[i]]], "score": float(query_scores[i])}
+                for i in np.argsort(-query_scores)[:n_results]
+            ])
+        return results
@@ -1,4 +1,7 @@
 from llm_config import *
+from common.resume import open_output, read_fingerprint
+from common.tracing import finish_trace, span, start_trace, trace_item
+from prejudge import prejudge
 import json
 import time
 
@@ -50,81 +53,177 @@ Prediction: The context information does not provide specific details about any
 Accuracy: True
 """
 
-def llm_as_judge_evaluate(stage):
+BATCH_INSTRUCTIONS = """
+# Batch: 
+You are given several numbered cases at once. Judge each case independently following the instructions above.
+Respond with only a single JSON string with a "Results" field, which is a list containing one object per case with the case "Id" and its "Accuracy" which is "True" or "False".
+"""
+
+JUDGE_BATCH_SIZE=1
+
+def format_ground_truth(item: dict) -> str:
+    ground_truth = item["ground_truth"].strip()
+    alt_ans = [answer.strip() for answer in item.get("alt_ans", []) if answer.strip()]
+
+    return json.dumps([ground_truth] + alt_ans) if alt_ans else ground_truth
+
+def parse_accuracy(model_resp: dict) -> bool:
+    return "accuracy" in model_resp and (
+        (model_resp["accuracy"] is True)
+        or (
+            isinstance(model_resp["accuracy"], str)
+            and model_resp["accuracy"].lower() == "true"
+        )
+    )
+
+def judge_with_llm(test_case_id, query: str, ground_truth: str, prediction: str) -> bool:
+    messages = [
+        {"role": "system", "content": INSTRUCTIONS + IN_CONTEXT_EXAMPLES},
+        {"role": "user", "content": f"Question: {query}\n Ground truth: {ground_truth}\n Prediction: {prediction}\n"}
+    ]
+
+    max_attempts = 3
+    for attempt in range(max_attempts):
+        try:
+            response = llm.chat.completions.create(
+                model=MODEL_NAME,
+                temperature=TEMPERATURE,
+                messages=messages,
+                response_format={"type": "json_object"},
+                use_cache=attempt == 0
+            )
+
+            response = response.choices[0].message.content
+            response_lower = response.lower()
+            model_resp = json.loads(response_lower)
+
+            result = parse_accuracy(model_resp)
+            print(f"Test case {test_case_id} evaluated, accuracy: {result}")
+            return result
+        except Exception as e:
+            if attempt + 1 < max_attempts:
+                time.sleep(1)
+                print(f"Retry {attempt + 1}: {str(e)}")
+            else:
+                print(f"Failed to evaluate test case {test_case_id} after {max_attempts} attempts: {str(e)}")
+
+    return False
+
+def judge_batch_with_llm(cases: list) -> dict:
+    # cases are (test_case_id, query, ground_truth, prediction) tuples judged in one request;
+    # cases missing from the response are judged one by one
+    user_prompt = "\n".join(
+        f"Case {test_case_id}:\n Question: {query}\n Ground truth: {ground_truth}\n Prediction: {prediction}\n"
+        for test_case_id, query, ground_truth, prediction in cases
+    )
+    messages = [
+        {"role": "system", "content": INSTRUCTIONS + IN_CONTEXT_EXAMPLES + BATCH_INSTRUCTIONS},
+        {"role": "user", "content": user_prompt}
+    ]
+
+    results = {}
+    try:
+        response = llm.chat.completions.create(
+            model=MODEL_NAME,
+            temperature=TEMPERATURE,
+            messages=messages,
+            response_format={"type": "json_object"}
+        )
+
+        model_resp = json.loads(response.choices[0].message.content.lower())
+        for case_resp in model_resp.get("results", []):
+            results[str(case_resp.get("id"))] = parse_accuracy(case_resp)
+    except Exception as e:
+        print(f"Failed to evaluate batch of {len(cases)} test cases: {str(e)}")
+
+    judged = {}
+    for test_case_id, query, ground_truth, prediction in cases:
+        if str(test_case_id) in results:
+            judged[test_case_id] = results[str(test_case_id)]
+            print(f"Test case {test_case_id} evaluated, accuracy: {judged[test_case_id]}")
+        else:
+            judged[test_case_id] = judge_with_llm(test_case_id, query, ground_truth, prediction)
+
+    return judged
+
+def llm_as_judge_evaluate(stage, batch_size: int = JUDGE_BATCH_SIZE):
     test_cases_path = f"../results/{stage}/test_cases.jsonl"
     judge_results_path = f"../results/{stage}/judge_results.jsonl"
     
-    with open(test_cases_path, "r") as test_cases_file, \
-         open(judge_results_path, "w") as judge_results_file:
+    judge_results_file, done_ids = open_output(judge_results_path, {
+        "stage": "judge",
+        "test_cases": read_fingerprint(test_cases_path),
+        "model_name": MODEL_NAME,
+        "temperature": TEMPERATURE,
+        "batch_size": batch_size
+    })
+    start_trace(f"{stage}_judge_results", resume=bool(done_ids))
+
+    evaluated = 0
+    resolved_locally = 0
+
+    with open(test_cases_path, "r") as test_cases_file, judge_results_file:
         
-        test_cases = [json.loads(line) for line in test_cases_file]
-
+        test_cases = (item for item in map(json.loads, test_cases_file) if item["id"] not in done_ids)
+
+        def write_result(test_case_id, accuracy: bool):
+            with span("write"):
+                judge_results_file.write(json.dumps({"id": test_case_id, "accuracy": accuracy}) + "\n")
+                judge_results_file.flush()
+
+        def flush_pending():
+            if len(pending) == 1:
+                with span("judge", cases=1):
+                    accuracy = judge_with_llm(*pending[0])
+                write_result(pending[0][0], accuracy)
+            elif pending:
+                with span("judge", cases=len(pending)):
+                    judged = judge_batch_with_llm(pending)
+                for test_case_id, accuracy in judged.items():
+                    write_result(test_case_id, accuracy)
+            pending.clear()
+
+        pending = []
         for item in test_cases:
-            test_case_id = item["id"]
-            judge_result = {"id": test_case_id, "accuracy": False}
-            query = item["query"]
-            ground_truth = item["ground_truth"].strip()
+            with trace_item(item["id"]):
+                test_case_id = item["id"]
+                query = item["query"]
             
-            if "new_answer" in item:
-                prediction = item["new_answer"]
-            else:
-                prediction = item["answer"]
+                if "new_answer" in item:
+                    prediction = item["new_answer"]
+                else:
+                    prediction = item["answer"]
+
+                evaluated += 1
+
+                if prediction is None:
+                    resolved_locally += 1
+                    print(f"Test case {test_case_id} evaluated, accuracy: False")
+                    write_result(test_case_id, False)
+                    continue
 
-            if prediction is None:
-                print(f"Test case {test_case_id} evaluated, accuracy: {judge_result['accuracy']}")
-            else:
                 prediction = prediction.strip()
+                ground_truths = [item["ground_truth"].strip()] + item.get("alt_ans", [])
 
-                ground_truth_lowercase = ground_truth.lower()
-                prediction_lowercase = prediction.lower()
-
-                messages = [
-                    {"role": "system", "content": INSTRUCTIONS + IN_CONTEXT_EXAMPLES},
-                    {"role": "user", "content": f"Question: {query}\n Ground truth: {ground_truth}\n Prediction: {prediction}\n"}
-                ]
-                
-                if "i don't know" in prediction_lowercase:
-                    pass
-                elif prediction_lowercase == ground_truth_lowercase:
-                    judge_result["accuracy"] = True
-                else:
-                    max_attempts = 3
-                    for attempt in range(max_attempts):
-                        try:
-                            response = llm.chat.completions.create(
-                                model=MODEL_NAME,
-                                temperature=TEMPERATURE,
-                                messages=messages,
-                                response_format={"type": "json_object"}
-                            )
-
-                            response = response.choices[0].message.content
-                            response_lower = response.lower()
-                            model_resp = json.loads(response_lower)
-                            
-                            if "accuracy" in model_resp and (
-                                (model_resp["accuracy"] is True)
-                                or (
-                                    isinstance(model_resp["accuracy"], str)
-                                    and model_resp["accuracy"].lower() == "true"
-                                )
-                            ):
-                                judge_result["accuracy"] = True
-                            
-                            result = judge_result["accuracy"]
-                            print(f"Test case {test_case_id} evaluated, accuracy: {result}")
-                            break
-                        except Exception as e:
-                            if attempt + 1 < max_attempts:
-                                time.sleep(1)
-                                print(f"Retry {attempt + 1}: {str(e)}")
-                            else:
-                                print(f"Failed to evaluate test case {test_case_id} after {max_attempts} attempts: {str(e)}")
-            
-            judge_results_file.write(json.dumps(judge_result) + "\n")
-            judge_results_file.flush()
+                # Clear cases are judged by rules, only ambiguous ones go to the LLM
+                with span("prejudge"):
+                    accuracy = prejudge(query, prediction, ground_truths)
+                if accuracy is not None:
+                    resolved_locally += 1
+                    write_result(test_case_id, accuracy)
+                    continue
+
+                pending.append((test_case_id, query, format_ground_truth(item), prediction))
+                if len(pending) >= batch_size:
+                    flush_pending()
+
+        flush_pending()
     
     print(f"LLM as judge evaluation completed. Results stored in {judge_results_path}")
+    if evaluated > 0:
+        print(f"Resolved {resolved_locally} of {evaluated} test cases ({resolved_locally / evaluated:.2%}) without an LLM call")
+    print(llm.cache_report())
+    print(finish_trace())
 
 stage_mapping = {
     "1": "none",
@@ -137,9 +236,10 @@ stage_mapping = {
     "8": "pre-retrieval+cot+rig"
 }
 
-user_input = input("Select stage (1: none, 2: pre-retrieval, 3: cot, 4: rig, 5: pre-retrieval+cot, 6: cot+rig, 7: pre-retrieval+rig, 8: pre-retrieval+cot+rig): ")
-if user_input not in stage_mapping:
-    raise ValueError("Invalid stage selected. Please input a number between 1 and 8")
+if __name__ == "__main__":
+    user_input = input("Select stage (1: none, 2: pre-retrieval, 3: cot, 4: rig, 5: pre-retrieval+cot, 6: cot+rig, 7: pre-retrieval+rig, 8: pre-retrieval+cot+rig): ")
+    if user_input not in stage_mapping:
+        raise ValueError("Invalid stage selected. Please input a number between 1 and 8")
 
-stage = stage_mapping[user_input]
-llm_as_judge_evaluate(stage)
\ No newline at end of file
+    stage = stage_mapping[user_input]
+    llm_as_judge_evaluate(stage)
\ No newline at end of file
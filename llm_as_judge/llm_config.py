@@ -1,9 +1,17 @@
 from openai import AzureOpenAI
+import sys
 
-llm = AzureOpenAI(
+sys.path.append("..")
+from common.llm_cache import LLMCache, CachedLLM
+
+USE_LLM_CACHE=True
+
+llm_cache = LLMCache() if USE_LLM_CACHE else None
+
+llm = CachedLLM(AzureOpenAI(
     api_key="AZURE_API_KEY",
     api_version="AZURE_API_VERSION",
     azure_endpoint="AZURE_ENDPOINT"
-)
+), llm_cache)
 MODEL_NAME="AZURE_MODEL_NAME"
 TEMPERATURE=0.0
\ No newline at end of file
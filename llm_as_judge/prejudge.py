@@ -0,0 +1,126 @@
+from datetime import date
+from typing import List, Optional, Set
+import re
+import string
+
+CONTAINMENT_MAX_WORDS=40
+
+NEGATION_WORDS = {"not", "no", "never", "none", "cannot", "unable", "neither", "nor", "isn't", "wasn't", "doesn't", "didn't", "don't", "aren't", "weren't"}
+HEDGE_WORDS = {"or", "either", "possibly", "perhaps", "maybe", "might", "unclear", "uncertain", "approximately", "around", "about"}
+YES_NO = {"yes", "no"}
+MULTIPLIERS = {"thousand": 1e3, "million": 1e6, "billion": 1e9, "trillion": 1e12}
+MONTHS = {
+    name: number
+    for number, names in enumerate([
+        ("january", "jan"), ("february", "feb"), ("march", "mar"), ("april", "apr"), ("may",), ("june", "jun"),
+        ("july", "jul"), ("august", "aug"), ("september", "sep", "sept"), ("october", "oct"), ("november", "nov"), ("december", "dec")
+    ], start=1)
+    for name in names
+}
+
+NUMBER_PATTERN = re.compile(r"(?<![\w.])(-?\d[\d,]*(?:\.\d+)?)(?:\s*(thousand|million|billion|trillion))?", re.IGNORECASE)
+ISO_DATE_PATTERN = re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b")
+MONTH_FIRST_PATTERN = re.compile(r"\b([a-z]{3,9})\.?\s+(\d{1,2})(?:st|nd|rd|th)?,?\s+(\d{4})\b", re.IGNORECASE)
+DAY_FIRST_PATTERN = re.compile(r"\b(\d{1,2})(?:st|nd|rd|th)?\s+(?:of\s+)?([a-z]{3,9})\.?,?\s+(\d{4})\b", re.IGNORECASE)
+SLASH_DATE_PATTERN = re.compile(r"\b(\d{1,2})/(\d{1,2})/(\d{4})\b")
+
+def normalize(text: str) -> str:
+    text = text.lower()
+    text = "".join(" " if char in string.punctuation and char not in "'$%" else char for char in text)
+    text = re.sub(r"\b(a|an|the)\b", " ", text)
+    return " ".join(text.split())
+
+def parse_numbers(text: str) -> Set[float]:
+    numbers = set()
+    for match in NUMBER_PATTERN.finditer(text):
+        value = float(match.group(1).replace(",", ""))
+        if match.group(2):
+            value *= MULTIPLIERS[match.group(2).lower()]
+        numbers.add(value)
+    return numbers
+
+def parse_dates(text: str) -> Set[date]:
+    dates = set()
+
+    def add(year, month, day):
+        try:
+            dates.add(date(int(year), int(month), int(day)))
+        except ValueError:
+            pass
+
+    for year, month, day in ISO_DATE_PATTERN.findall(text):
+        add(year, month, day)
+    for month, day, year in MONTH_FIRST_PATTERN.findall(text):
+        if month.lower() in MONTHS:
+            add(year, MONTHS[month.lower()], day)
+    for day, month, year in DAY_FIRST_PATTERN.findall(text):
+        if month.lower() in MONTHS:
+            add(year, MONTHS[month.lower()], day)
+    for month, day, year in SLASH_DATE_PATTERN.findall(text):
+        add(year, month, day)
+
+    return dates
+
+def is_single_number(text: str) -> bool:
+    return re.fullmatch(r"[$€£]?\s*-?\d[\d,]*(?:\.\d+)?\s*(?:%|thousand|million|billion|trillion)?", text.strip(), re.IGNORECASE) is not None
+
+def number_tolerance(text: str) -> float:
+    # Half a unit of the last digit given in the ground truth, e.g. 0.005 for "$35.78"
+    match = NUMBER_PATTERN.search(text)
+    decimals = len(match.group(1).split(".")[1]) if "." in match.group(1) else 0
+    multiplier = MULTIPLIERS[match.group(2).lower()] if match.group(2) else 1
+    return 0.5 * 10 ** -decimals * multiplier
+
+def numbers_match(expected: float, predicted: float, tolerance: float) -> bool:
+    return abs(expected - predicted) < tolerance + 1e-9
+
+def prejudge(query: str, prediction: str, ground_truths: List[str]) -> Optional[bool]:
+    # Returns the judgement when it is clear without the LLM, None when the case is ambiguous
+    prediction_lowercase = prediction.lower()
+    if "i don't know" in prediction_lowercase:
+        return False
+
+    normalized_answers = [normalize(answer) for answer in ground_truths]
+    if "invalid question" in normalized_answers:
+        return None
+
+    normalized_prediction = normalize(prediction)
+    prediction_words = normalized_prediction.split()
+    hedged = bool((NEGATION_WORDS | HEDGE_WORDS) & set(prediction_words)) or "n't" in prediction_lowercase
+
+    for answer, normalized_answer in zip(ground_truths, normalized_answers):
+        if not normalized_answer:
+            continue
+
+        if normalized_prediction == normalized_answer:
+            return True
+
+        if normalized_answer in YES_NO:
+            if prediction_words and prediction_words[0] == normalized_answer and len(prediction_words) <= CONTAINMENT_MAX_WORDS:
+                return True
+            continue
+
+        if hedged or len(prediction_words) > CONTAINMENT_MAX_WORDS:
+            continue
+
+        # Numbers and dates count when the prediction states exactly one, ignoring those from the query
+        if is_single_number(answer):
+            predicted_numbers = parse_numbers(prediction) - parse_numbers(query)
+            expected_numbers = parse_numbers(answer)
+            if len(predicted_numbers) == 1 and len(expected_numbers) == 1 \
+                    and numbers_match(next(iter(expected_numbers)), next(iter(predicted_numbers)), number_tolerance(answer)):
+                return True
+            continue
+
+        expected_dates = parse_dates(answer)
+        if len(expected_dates) == 1:
+            predicted_dates = parse_dates(prediction) - parse_dates(query)
+            if predicted_dates == expected_dates:
+                return True
+
+        # The answer has to lead the prediction, e.g. "Paris, the capital of France". Answers naming
+        # another entity can still mention the ground truth later on and are left to the LLM
+        if re.match(rf"{re.escape(normalized_answer)}(?!\S)", normalized_prediction):
+            return True
+
+    return None
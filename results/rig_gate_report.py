@@ -0,0 +1,55 @@
+import json
+import os
+
+rig_stages = {
+    "rig": "none",
+    "cot+rig": "cot",
+    "pre-retrieval+rig": "pre-retrieval",
+    "pre-retrieval+cot+rig": "pre-retrieval+cot"
+}
+
+def read_jsonl(file_path):
+    records = {}
+    with open(file_path, "r") as file:
+        for line in file:
+            try:
+                data = json.loads(line)
+                records[data["id"]] = data
+            except (json.JSONDecodeError, KeyError):
+                continue
+    return records
+
+def average_accuracy(judge_results, ids):
+    return sum(1 if judge_results[test_case_id]["accuracy"] else 0 for test_case_id in ids) / len(ids) if ids else 0
+
+def rig_gate_report(rig_stage, input_stage):
+    # Accuracy of the answers RIG started from and of those it produced, on the test cases judged
+    # in both stages, next to the LLM calls gating made and saved
+    test_cases = read_jsonl(f"{rig_stage}/test_cases.jsonl")
+    rig_judge_results = read_jsonl(f"{rig_stage}/judge_results.jsonl")
+    input_judge_results = read_jsonl(f"{input_stage}/judge_results.jsonl")
+    ids = [test_case_id for test_case_id in test_cases if test_case_id in rig_judge_results and test_case_id in input_judge_results]
+
+    input_accuracy = average_accuracy(input_judge_results, ids)
+    rig_accuracy = average_accuracy(rig_judge_results, ids)
+    print(f"{rig_stage}: accuracy {input_accuracy:.4f} -> {rig_accuracy:.4f} ({rig_accuracy - input_accuracy:+.4f}) on {len(ids)} test cases")
+
+    gates = [test_case["rig_gate"] for test_case in test_cases.values() if "rig_gate" in test_case]
+    if not gates:
+        print("  generated without gating")
+        return
+
+    skipped_test_cases = sum(gate["skipped"] is not None for gate in gates)
+    details = [detail for test_case in test_cases.values() for detail in test_case.get("details_verification") or []]
+    skipped_details = sum("skipped" in detail for detail in details)
+    llm_calls = sum(gate["llm_calls"] for gate in gates)
+    llm_calls_saved = sum(gate["llm_calls_saved"] for gate in gates)
+    print(f"  skipped {skipped_test_cases} of {len(gates)} test cases and {skipped_details} of {len(details)} extracted details")
+    print(
+        f"  {llm_calls} LLM calls made, at least {llm_calls_saved} saved "
+        f"({llm_calls_saved / (llm_calls + llm_calls_saved) if llm_calls + llm_calls_saved else 0:.2%} of the calls without gating)"
+    )
+
+for rig_stage, input_stage in rig_stages.items():
+    if os.path.exists(f"{rig_stage}/judge_results.jsonl") and os.path.exists(f"{input_stage}/judge_results.jsonl"):
+        rig_gate_report(rig_stage, input_stage)
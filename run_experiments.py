@@ -0,0 +1,123 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import nullcontext
+from typing import Dict, List, Tuple
+import json
+import os
+import subprocess
+import sys
+import threading
+
+BASE_DIR=os.path.dirname(os.path.abspath(__file__))
+STAGES=["none", "pre-retrieval", "cot", "rig", "pre-retrieval+cot", "cot+rig", "pre-retrieval+rig", "pre-retrieval+cot+rig"]
+# Steps whose dependencies are done run concurrently, at most MAX_PARALLEL_STEPS at once.
+# Steps loading the embedding model (contexts generation and RIG) are limited separately
+MAX_PARALLEL_STEPS=4
+MAX_PARALLEL_EMBEDDING_STEPS=1
+
+_print_lock = threading.Lock()
+
+def stage_options(stage: str) -> Tuple[bool, bool, bool]:
+    options = set(stage.split("+")) - {"none"}
+    return "pre-retrieval" in options, "cot" in options, "rig" in options
+
+def answers_stage(use_pre_retrieval: bool, use_cot: bool) -> str:
+    options = [name for name, used in (("pre-retrieval", use_pre_retrieval), ("cot", use_cot)) if used]
+    return "+".join(options) or "none"
+
+def build_steps(stages: List[str]) -> Dict[str, Dict]:
+    # Each step is executed once however many stages depend on it:
+    # contexts are shared by the answers with and without CoT, answers by their RIG variant
+    steps = {}
+
+    def add_step(name: str, directory: str, code: str, depends_on: List[str], uses_embedding: bool = False):
+        steps.setdefault(name, {"directory": directory, "code": code, "depends_on": depends_on, "uses_embedding": uses_embedding})
+
+    for stage in stages:
+        use_pre_retrieval, use_cot, use_rig = stage_options(stage)
+        contexts_step = f"contexts:{'with' if use_pre_retrieval else 'without'}-pre-retrieval"
+        answers_step = f"answers:{answers_stage(use_pre_retrieval, use_cot)}"
+
+        add_step(
+            contexts_step, "generate_contexts",
+            "from generate_contexts import *; "
+            f"generate_contexts(EMBED_MODEL, CHUNK_SIZE, CHUNK_OVERLAP, SIMILARITY_TOP_K, DISTANCE_METRIC, {use_pre_retrieval})",
+            [], uses_embedding=True
+        )
+        add_step(
+            answers_step, "generate_answers",
+            f"from generate_answers import process_test_cases; process_test_cases({use_pre_retrieval}, {use_cot})",
+            [contexts_step]
+        )
+
+        final_step = answers_step
+        if use_rig:
+            final_step = f"rig:{answers_stage(use_pre_retrieval, use_cot)}"
+            add_step(
+                final_step, "generate_answers",
+                f"from rig import process_test_cases; process_test_cases({use_pre_retrieval}, {use_cot})",
+                [answers_step], uses_embedding=True
+            )
+
+        add_step(
+            f"judge:{stage}", "llm_as_judge",
+            f"from llm_as_judge import llm_as_judge_evaluate; llm_as_judge_evaluate({json.dumps(stage)})",
+            [final_step]
+        )
+
+    return steps
+
+def run_step(name: str, step: Dict, embedding_slots: threading.Semaphore):
+    # Steps run in their own directory and process, as they would when executed by hand
+    with embedding_slots if step["uses_embedding"] else nullcontext():
+        process = subprocess.Popen(
+            [sys.executable, "-u", "-c", step["code"]],
+            cwd=os.path.join(BASE_DIR, step["directory"]),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True
+        )
+        for line in process.stdout:
+            with _print_lock:
+                print(f"[{name}] {line}", end="")
+
+        if process.wait() != 0:
+            raise RuntimeError(f"Step {name} failed with exit code {process.returncode}")
+
+def judge_average(stage: str) -> float:
+    with open(os.path.join(BASE_DIR, "results", stage, "judge_results.jsonl"), "r") as judge_results_file:
+        accuracies = [json.loads(line)["accuracy"] for line in judge_results_file if line.strip()]
+    return sum(accuracies) / len(accuracies) if accuracies else 0
+
+def run_experiments(stages: List[str] = STAGES, max_parallel_steps: int = MAX_PARALLEL_STEPS):
+    steps = build_steps(stages)
+    embedding_slots = threading.Semaphore(MAX_PARALLEL_EMBEDDING_STEPS)
+    done = set()
+    running = {}
+
+    print(f"Running {len(steps)} steps for {len(stages)} stages")
+
+    with ThreadPoolExecutor(max_workers=max_parallel_steps) as executor:
+        while len(done) < len(steps):
+            for name, step in steps.items():
+                if name not in done and name not in running.values() and all(dependency in done for dependency in step["depends_on"]):
+                    running[executor.submit(run_step, name, step, embedding_slots)] = name
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                # A failed step stops the run; the finished steps are resumed by the next run
+                future.result()
+                done.add(name)
+                print(f"Step {name} completed ({len(done)} of {len(steps)})")
+
+    for stage in stages:
+        print(f"Average score of LLM as judge for {stage}: {judge_average(stage)}")
+
+if __name__ == "__main__":
+    selected_stages = sys.argv[1:] or STAGES
+    unknown_stages = [stage for stage in selected_stages if stage not in STAGES]
+    if unknown_stages:
+        raise ValueError(f"Unknown stages {unknown_stages}, choose from {STAGES}")
+
+    run_experiments(selected_stages)